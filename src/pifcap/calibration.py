@@ -0,0 +1,374 @@
+"""
+master calibration frames: building with bounded memory and applying during conversion
+
+Master bias, dark and flat frames are combined from many frames tile by tile: for a band of rows the
+pixels of all input frames are copied into one float32 stack (frames are memory mapped, only the rows
+of the current tile get read) and reduced with median or sigma clipped mean. The tile height follows
+from the memory limit, so memory use does not depend on frame size or number of frames as long as one
+row of every frame fits into the limit.
+
+Masters are stored as .npy files in a calibration folder together with an index (masters.json) and
+are selected by raw mode, exposure time and gain of the frame to calibrate.
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+import numpy as np
+
+from . import pifcap_image
+from . import pifcap_sequence
+
+FrameTypes = ("Bias", "Dark", "Flat")
+Methods = ("median", "sigma clip")
+# index of masters in calibration folder
+IndexName = "masters.json"
+
+
+def get_PixelDtype(format):
+    """return dtype of pixel values of raw format string"""
+    BayerPattern, bit_depth = pifcap_image.parse_Format(format)
+    return np.dtype(np.uint16) if bit_depth > 8 else np.dtype(np.uint8)
+
+
+def get_ModeKey(img):
+    """return raw mode of a frame: (format, pixel array shape, binning)"""
+    # first row only: packed frames do not get unpacked completely
+    Width = img.get_Rows(0, 1).view(get_PixelDtype(img.format)).shape[1]
+    return img.format, (img.shape[0], Width), tuple(img.metadata.get("Binning", (1, 1)))
+
+
+def _iter_Selected(Frames):
+    """yield images of a list of (file name, frame index or None), opening each sequence file once"""
+    Reader = None
+    try:
+        for filename, idx in Frames:
+            if idx is None:
+                yield pifcap_image.Image.load(filename)
+                continue
+            if (Reader is None) or (Reader.filename != filename):
+                if Reader is not None:
+                    Reader.close()
+                Reader = pifcap_sequence.SequenceReader(filename)
+            yield Reader[idx]
+    finally:
+        if Reader is not None:
+            Reader.close()
+
+
+def sigma_clipped_mean(Stack, Sigma=3.0, Iterations=3):
+    """mean along first axis ignoring values more than Sigma standard deviations off
+
+    Args:
+        Stack: float array (frames, rows, columns), clipped values get overwritten with NaN
+
+    Returns:
+        2-dim float32 array
+    """
+    for _ in range(Iterations):
+        Mean = np.nanmean(Stack, axis=0)
+        Std = np.nanstd(Stack, axis=0)
+        Outliers = np.abs(Stack - Mean) > Sigma * Std
+        if not Outliers.any():
+            break
+        Stack[Outliers] = np.nan
+    return np.nanmean(Stack, axis=0)
+
+
+def combine_Frames(Frames, format, shape, Method="median", Sigma=3.0, MemoryLimit=256 * 2 ** 20):
+    """combine frames pixel by pixel, tile by tile
+
+    Args:
+        Frames: list of (file name, frame index or None)
+        format: raw format string of the frames
+        shape: pixel array shape of the frames
+        Method: "median" or "sigma clip"
+        Sigma: clipping threshold in standard deviations
+        MemoryLimit: approximate memory for tile stack and temporaries in bytes
+
+    Returns:
+        float32 array
+
+    Raises:
+        ValueError: when one row of all frames does not fit into MemoryLimit
+    """
+    if Method not in Methods:
+        raise ValueError(f'unknown combination method {Method}')
+    dtype = get_PixelDtype(format)
+    nFrames = len(Frames)
+    # sigma clipping needs temporaries of stack size
+    BytesPerRow = nFrames * shape[1] * 4 * (1 if Method == "median" else 4)
+    if BytesPerRow > MemoryLimit:
+        raise ValueError(
+            f'combining {nFrames} frames with method {Method} needs at least {BytesPerRow / 2 ** 20:.1f} MiB, '
+            f'more than the memory limit of {MemoryLimit / 2 ** 20:.1f} MiB'
+        )
+    TileRows = int(min(shape[0], MemoryLimit // BytesPerRow))
+    Master = np.empty(shape, dtype=np.float32)
+    Stack = np.empty((nFrames, TileRows, shape[1]), dtype=np.float32)
+    # open all frames once, pixel data stay memory mapped
+    Images = list(_iter_Selected(Frames))
+    for r0 in range(0, shape[0], TileRows):
+        r1 = min(r0 + TileRows, shape[0])
+        Tile = Stack[:, :r1 - r0]
+        for i, img in enumerate(Images):
+            np.copyto(Tile[i], img.get_Rows(r0, r1).view(dtype), casting="unsafe")
+        if Method == "median":
+            Master[r0:r1] = np.median(Tile, axis=0, overwrite_input=True)
+        else:
+            Master[r0:r1] = sigma_clipped_mean(Tile, Sigma=Sigma)
+    return Master
+
+
+def normalize_Flat(Flat, format):
+    """divide flat by mean of each Bayer channel (mono: of whole image), in place
+
+    Pixels without signal get 1 to not amplify them.
+    """
+    BayerPattern, bit_depth = pifcap_image.parse_Format(format)
+    Planes = [Flat] if BayerPattern is None else [Flat[i::2, j::2] for i in range(2) for j in range(2)]
+    for Plane in Planes:
+        Plane /= max(float(Plane.mean()), 1e-6)
+    Flat[Flat <= 0] = 1.0
+    return Flat
+
+
+class CalibrationLibrary:
+    """folder with master frames
+
+    Masters are loaded memory mapped when needed first; the masters selected for a frame are cached by
+    raw mode, exposure time and gain.
+    """
+
+    def __init__(self, Folder):
+        self.Folder = Folder
+        IndexFile = os.path.join(Folder, IndexName)
+        if os.path.isfile(IndexFile):
+            with open(IndexFile, "r") as fh:
+                self.Index = json.load(fh)
+        else:
+            self.Index = list()
+        # master file name -> array
+        self._Arrays = dict()
+        # (raw mode, exposure, gain) -> (offset master, flat master, names)
+        self._Masters = dict()
+        self._Buffers = dict()
+
+    def _save_Index(self):
+        IndexFile = os.path.join(self.Folder, IndexName)
+        TempName = pifcap_image.get_TempName(IndexFile)
+        with open(TempName, "w") as fh:
+            json.dump(self.Index, fh, indent=1)
+        os.replace(TempName, IndexFile)
+
+    def add(self, FrameType, ModeKey, ExposureTime, AnalogueGain, Master, nFrames, Method):
+        """store master frame, replacing an existing master with the same key
+
+        Returns:
+            file name of master
+        """
+        format, shape, binning = ModeKey
+        Name = (
+            f'master_{FrameType.lower()}_{format}_{shape[1]}x{shape[0]}_bin{binning[0]}x{binning[1]}'
+            f'_{ExposureTime}us_gain{AnalogueGain:g}.npy'
+        )
+        os.makedirs(self.Folder, exist_ok=True)
+        FileName = os.path.join(self.Folder, Name)
+        TempName = pifcap_image.get_TempName(FileName)
+        with open(TempName, "wb") as fh:
+            np.save(fh, Master.astype(np.float32, copy=False))
+        os.replace(TempName, FileName)
+        Entry = {
+            "type": FrameType, "format": format, "shape": list(shape), "binning": list(binning),
+            "exposure": ExposureTime, "gain": AnalogueGain, "frames": nFrames, "method": Method, "file": Name,
+        }
+        self.Index = [e for e in self.Index if e["file"] != Name] + [Entry]
+        self._save_Index()
+        self._Arrays.pop(Name, None)
+        self._Masters.clear()
+        return FileName
+
+    def find(self, FrameType, ModeKey, ExposureTime=None, AnalogueGain=None):
+        """return (name, array) of master matching raw mode and, when given, exposure time and gain
+
+        Returns:
+            (None, None) when there is no matching master
+        """
+        format, shape, binning = ModeKey
+        for e in reversed(self.Index):
+            if (e["type"] != FrameType) or (e["format"] != format):
+                continue
+            if (tuple(e["shape"]) != tuple(shape)) or (tuple(e["binning"]) != tuple(binning)):
+                continue
+            if (ExposureTime is not None) and (e["exposure"] != ExposureTime):
+                continue
+            if (AnalogueGain is not None) and (e["gain"] != AnalogueGain):
+                continue
+            if e["file"] not in self._Arrays:
+                self._Arrays[e["file"]] = np.load(os.path.join(self.Folder, e["file"]), mmap_mode="r")
+            return e["file"], self._Arrays[e["file"]]
+        return None, None
+
+    def get_Offset(self, ModeKey, ExposureTime, AnalogueGain):
+        """return (name, array) of dark with same exposure time and gain, else bias with same gain"""
+        Name, Offset = self.find("Dark", ModeKey, ExposureTime, AnalogueGain)
+        if Offset is None:
+            Name, Offset = self.find("Bias", ModeKey, AnalogueGain=AnalogueGain)
+        return Name, Offset
+
+    def get_Masters(self, img):
+        """return (offset master or None, flat master or None, list of master names) for a frame"""
+        ModeKey = get_ModeKey(img)
+        Key = (ModeKey, img.metadata["ExposureTime"], img.metadata["AnalogueGain"])
+        if Key not in self._Masters:
+            Names = list()
+            OffsetName, Offset = self.get_Offset(*Key)
+            if Offset is not None:
+                Names.append(OffsetName)
+            FlatName, Flat = self.find("Flat", ModeKey, AnalogueGain=Key[2])
+            if Flat is None:
+                FlatName, Flat = self.find("Flat", ModeKey)
+            if Flat is not None:
+                Names.append(FlatName)
+            self._Masters[Key] = (Offset, Flat, Names)
+        return self._Masters[Key]
+
+    def _get_Buffer(self, name, shape, dtype):
+        """return reusable array"""
+        Buffer = self._Buffers.get(name, None)
+        if (Buffer is None) or (Buffer.shape != shape) or (Buffer.dtype != dtype):
+            Buffer = np.empty(shape, dtype=dtype)
+            self._Buffers[name] = Buffer
+        return Buffer
+
+    def apply(self, img):
+        """calibrate frame: (frame - dark or bias) / flat + black level
+
+        The black level (from SensorBlackLevels) is added back after subtracting the dark or bias to
+        not clip the noise of dark pixels.
+
+        Args:
+            img: pifcap_image.Image
+
+        Returns:
+            calibrated pifcap_image.Image (pixel data overwritten by next call) or img when there are
+            no matching masters
+        """
+        Offset, Flat, Names = self.get_Masters(img)
+        if len(Names) == 0:
+            return img
+        BayerPattern, bit_depth = pifcap_image.parse_Format(img.format)
+        dtype = get_PixelDtype(img.format)
+        array = img.array.view(dtype)
+        Work = self._get_Buffer("work", array.shape, np.float32)
+        np.copyto(Work, array, casting="unsafe")
+        if Offset is not None:
+            np.subtract(Work, Offset, out=Work)
+        if Flat is not None:
+            np.divide(Work, Flat, out=Work)
+        if Offset is not None:
+            SensorBlackLevels = img.metadata.get("SensorBlackLevels", None)
+            if SensorBlackLevels:
+                np.add(Work, np.mean(SensorBlackLevels) / 2 ** (16 - bit_depth), out=Work)
+        np.rint(Work, out=Work)
+        np.clip(Work, 0, 2 ** bit_depth - 1, out=Work)
+        Out = self._get_Buffer("out", array.shape, dtype)
+        np.copyto(Out, Work, casting="unsafe")
+        metadata = dict(img.metadata)
+        metadata["Calibration"] = Names
+        return pifcap_image.Image(array=Out, metadata=metadata, format=img.format, comment=img.comment)
+
+
+# calibration libraries of this process
+_Libraries = dict()
+
+
+def get_Library(Folder):
+    """return CalibrationLibrary of folder, loaded once per process"""
+    if Folder not in _Libraries:
+        _Libraries[Folder] = CalibrationLibrary(Folder)
+    return _Libraries[Folder]
+
+
+def build_Masters(input_filenames, Folder, Method="median", Sigma=3.0, MemoryLimit=256 * 2 ** 20, FrameType=None,
+                  verbose=False):
+    """build master frames from all calibration frames of the input files
+
+    Frames are grouped by frame type, raw mode, exposure time and gain; each group gives one master.
+    Biases are built first, then darks, then flats (with dark or bias subtracted and normalized).
+
+    Args:
+        input_filenames: single frame and sequence files
+        Folder: calibration folder
+        Method: "median" or "sigma clip"
+        Sigma: clipping threshold in standard deviations
+        MemoryLimit: approximate memory for combining in bytes
+        FrameType: use this frame type instead of the one stored in the frames
+
+    Returns:
+        list of master file names
+    """
+    # group frames, only metadata get read here
+    Groups = dict()
+    for filename, idx, img in pifcap_sequence.iter_Frames(input_filenames):
+        Type = FrameType or img.metadata.get("FrameType", "Light")
+        if Type not in FrameTypes:
+            continue
+        Key = (Type, get_ModeKey(img), img.metadata["ExposureTime"], img.metadata["AnalogueGain"])
+        Groups.setdefault(Key, list()).append((filename, idx))
+    Library = CalibrationLibrary(Folder)
+    MasterNames = list()
+    for Key in sorted(Groups, key=lambda k: FrameTypes.index(k[0])):
+        Type, ModeKey, ExposureTime, AnalogueGain = Key
+        Frames = Groups[Key]
+        if verbose:
+            print(f'combining {len(Frames)} {Type} frames ({ModeKey[0]}, {ExposureTime}us, gain {AnalogueGain:g})')
+        Master = combine_Frames(Frames, ModeKey[0], ModeKey[1], Method=Method, Sigma=Sigma, MemoryLimit=MemoryLimit)
+        if Type == "Flat":
+            OffsetName, Offset = Library.get_Offset(ModeKey, ExposureTime, AnalogueGain)
+            if Offset is not None:
+                Master -= Offset
+            normalize_Flat(Master, ModeKey[0])
+        MasterNames.append(
+            Library.add(Type, ModeKey, ExposureTime, AnalogueGain, Master, nFrames=len(Frames), Method=Method)
+        )
+    return MasterNames
+
+
+def main(argv=None):
+    """command line for `pifcap2fits calibrate`"""
+    parser = argparse.ArgumentParser(
+        prog='pifcap2fits calibrate',
+        description='build master bias, dark and flat frames from pifcap files',
+    )
+    parser.add_argument('-o', '--output', default='calibration',
+                        help='calibration folder to store the masters (default: "calibration")')
+    parser.add_argument('-m', '--method', choices=Methods, default='median',
+                        help='combination method (default: median)')
+    parser.add_argument('--sigma', type=float, default=3.0,
+                        help='clipping threshold in standard deviations for method "sigma clip" (default: 3.0)')
+    parser.add_argument('--memory', type=int, default=256,
+                        help='memory to use for combining frames in MiB (default: 256)')
+    parser.add_argument('-t', '--type', choices=FrameTypes, default=None,
+                        help='frame type of all input files (default: frame type stored in the files)')
+    parser.add_argument('-v', '--verbose', action="store_true",
+                        help='verbose messages')
+    parser.add_argument('files', metavar="path", nargs="+",
+                        help='calibration frames (*.pfc or *.pfcs); accepts "?", "*" and character ranges like "[a-z]"')
+    args = parser.parse_args(argv)
+    input_filenames = sorted({fn for pattern in args.files for fn in glob.glob(pattern) if os.path.isfile(fn)})
+    if len(input_filenames) == 0:
+        print('ERROR: no input files', file=sys.stderr)
+        sys.exit(1)
+    try:
+        MasterNames = build_Masters(
+            input_filenames, args.output, Method=args.method, Sigma=args.sigma, MemoryLimit=args.memory * 2 ** 20,
+            FrameType=args.type, verbose=args.verbose,
+        )
+    except ValueError as e:
+        print(f'ERROR: {e} (use a larger --memory or fewer frames)', file=sys.stderr)
+        sys.exit(1)
+    for Name in MasterNames:
+        print(f'wrote {Name}')
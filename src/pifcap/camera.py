@@ -2,7 +2,6 @@
 CameraControl class
 """
 import os.path
-import shutil
 import pickle
 import numpy as np
 import io
@@ -10,12 +9,22 @@ import re
 import threading
 import time
 import datetime
+import json
+import hashlib
+import collections
+import types
 from PyQt5 import QtCore
 
 
 from picamera2 import Picamera2
+import libcamera
 from libcamera import controls, Rectangle
 from . import pifcap_image
+from . import pifcap_sequence
+from . import serwriter
+from . import writer
+from . import timing
+from . import quality
 
 settings = {'name': 'camera hardware', 'type': 'group', 'children': [
     {
@@ -36,17 +45,99 @@ settings = {'name': 'camera hardware', 'type': 'group', 'children': [
         'name': 'force camera restarts', 'type': 'list', 'values': ['auto', 'yes', 'no'], 'value': 'auto',
         'tip': 'force camera restart after each exposure',
     },
+    {
+        'name': 'buffer count', 'type': 'int', 'value': 4, 'limits': [2, 32],
+        'tip': 'default number of camera buffers per raw mode; more buffers absorb jitter at high frame rates',
+    },
+    {
+        'name': 'buffer memory limit', 'type': 'int', 'value': 256, 'limits': [16, 4096], 'suffix': ' MiB',
+        'tip': 'limits the default number of camera buffers for large raw modes',
+    },
+    {
+        'name': 'force raw mode rediscovery', 'type': 'bool', 'value': False,
+        'tip': 'do not use cached raw modes and limits; discover them again when connecting the camera',
+    },
 ]}
 
+# cache for discovered raw modes
+RawModesCacheFile = os.path.join(os.path.expanduser("~"), ".cache", "pifcap", "raw_modes.json")
+
+
+def get_SoftwareVersions():
+    """return versions of picamera2 and libcamera (None when unknown)
+    """
+    try:
+        from importlib import metadata as importlib_metadata
+        picamera2_version = importlib_metadata.version("picamera2")
+    except Exception:
+        picamera2_version = None
+    try:
+        libcamera_version = libcamera.CameraManager.singleton().version
+    except Exception:
+        libcamera_version = None
+    return picamera2_version, libcamera_version
+
+
+def load_RawModesCache(Model, CacheKey):
+    """return cached raw modes of camera model or None when not cached or cache key does not match
+    """
+    try:
+        with open(RawModesCacheFile, "r") as fh:
+            Cache = json.load(fh)
+        Entry = Cache[Model]
+    except (OSError, ValueError, KeyError):
+        return None
+    if Entry.get("key") != CacheKey:
+        # camera, sensor modes or software versions changed
+        return None
+    try:
+        raw_modes = Entry["raw_modes"]
+        # JSON has no tuples
+        for raw_mode in raw_modes:
+            for k in ["size", "true_size", "binning"]:
+                raw_mode[k] = tuple(raw_mode[k])
+    except (KeyError, TypeError):
+        return None
+    return raw_modes
+
+
+def store_RawModesCache(Model, CacheKey, raw_modes):
+    """store raw modes of camera model in cache
+    """
+    try:
+        with open(RawModesCacheFile, "r") as fh:
+            Cache = json.load(fh)
+    except (OSError, ValueError):
+        Cache = dict()
+    Cache[Model] = {"key": CacheKey, "raw_modes": raw_modes}
+    os.makedirs(os.path.dirname(RawModesCacheFile), exist_ok=True)
+    with open(RawModesCacheFile, "w") as fh:
+        json.dump(Cache, fh, default=str, indent=1)
+
+
+CameraSettingsSnapshot = collections.namedtuple(
+    "CameraSettingsSnapshot", ["ModeVersion", "ControlsVersion", "RawMode", "Controls", "ROI"]
+)
+CameraSettingsSnapshot.__doc__ = """immutable state of camera settings
+
+ModeVersion: incremented when the camera needs a reconfiguration (raw mode, buffer count)
+ControlsVersion: incremented when camera controls change
+RawMode: read-only mapping of selected raw mode
+Controls: read-only mapping of camera controls
+ROI: region of interest (x, y, width, height) to store or None for full frame
+"""
+
 
 class CameraSettings:
     """exposure settings
+
+    Setters (GUI thread) publish a new immutable snapshot. The exposure loop reads the snapshot once
+    per frame and detects changes by comparing version numbers.
     """
 
     def __init__(self):
         self._RawModes = list()
         self._selected_RawMode_idx = None
-        self._is_newMode = True
         self._camera_controls = {
             "ExposureTime": 0.01,
             "AnalogueGain": 1.0,
@@ -56,31 +147,54 @@ class CameraSettings:
             "AwbEnable": False,
             "ColourGains": (2.0, 2.0),  # to compensate the 2 G pixel in Bayer pattern
         }
-        self._is_newControls = True
-        # make thread safe
+        # region of interest (x, y, width, height) to store or None for full frame
+        self._ROI = None
+        self._ModeVersion = 0
+        self._ControlsVersion = 0
+        # serializes setters; readers use the published snapshot without locking
         self._AccessLock = QtCore.QMutex()
+        self._Snapshot = None
+        self._publish()
+
+    def _publish(self, newMode=False, newControls=False):
+        """build and publish new snapshot; must be called with lock held
+        """
+        if newMode:
+            self._ModeVersion += 1
+        if newControls:
+            self._ControlsVersion += 1
+        if self._selected_RawMode_idx is None:
+            RawMode = None
+        else:
+            RawMode = types.MappingProxyType(dict(self._RawModes[self._selected_RawMode_idx]))
+        # replacing the reference is atomic
+        self._Snapshot = CameraSettingsSnapshot(
+            ModeVersion=self._ModeVersion,
+            ControlsVersion=self._ControlsVersion,
+            RawMode=RawMode,
+            Controls=types.MappingProxyType(dict(self._camera_controls)),
+            ROI=self._ROI,
+        )
 
+    def snapshot(self):
+        """return current CameraSettingsSnapshot"""
+        return self._Snapshot
 
     @property
     def available_RawModes(self):
-        self._AccessLock.lock()
-        ret = self._RawModes
-        self._AccessLock.unlock()
-        return ret
+        return self._RawModes
 
     @available_RawModes.setter
     def available_RawModes(self, rms):
         self._AccessLock.lock()
         self._RawModes = rms
+        self._selected_RawMode_idx = None
         self._AccessLock.unlock()
         self.set_RawModeFromIdx(0)
 
     @property
     def RawMode(self):
-        self._AccessLock.lock()
-        rm = self._RawModes[self._selected_RawMode_idx]
-        self._AccessLock.unlock()
-        return rm
+        return self._Snapshot.RawMode
 
     def set_RawModeFromIdx(self, idx):
         assert idx >= 0
@@ -88,7 +202,6 @@ class CameraSettings:
         self._AccessLock.lock()
         if idx != self._selected_RawMode_idx:
             self._selected_RawMode_idx = idx
-            self._is_newMode = True
             self._camera_controls["ExposureTime"] = min(
                 self._camera_controls["ExposureTime"],
                 self._RawModes[self._selected_RawMode_idx]["max_ExposureTime"]
@@ -105,50 +218,58 @@ class CameraSettings:
                 self._camera_controls["AnalogueGain"],
                 self._RawModes[self._selected_RawMode_idx]["min_AnalogueGain"]
             )
-            self._is_newControls = True
+            self._publish(newMode=True, newControls=True)
         self._AccessLock.unlock()
 
     @property
     def MaxExposureTime(self):
-        self._AccessLock.lock()
-        t = self._RawModes[self._selected_RawMode_idx]["max_ExposureTime"]
-        self._AccessLock.unlock()
-        return t / 1e6
+        return self._Snapshot.RawMode["max_ExposureTime"] / 1e6
 
     @property
     def MinExposureTime(self):
-        self._AccessLock.lock()
-        t = self._RawModes[self._selected_RawMode_idx]["min_ExposureTime"]
-        self._AccessLock.unlock()
-        return t / 1e6
+        return self._Snapshot.RawMode["min_ExposureTime"] / 1e6
 
     @property
     def MaxGain(self):
-        self._AccessLock.lock()
-        g = self._RawModes[self._selected_RawMode_idx]["max_AnalogueGain"]
-        self._AccessLock.unlock()
-        return g
+        return self._Snapshot.RawMode["max_AnalogueGain"]
 
     @property
     def MinGain(self):
+        return self._Snapshot.RawMode["min_AnalogueGain"]
+
+    @property
+    def BufferCount(self):
+        return self._Snapshot.RawMode["buffer_count"]
+
+    @BufferCount.setter
+    def BufferCount(self, n):
         self._AccessLock.lock()
-        g = self._RawModes[self._selected_RawMode_idx]["min_AnalogueGain"]
+        if n != self._RawModes[self._selected_RawMode_idx]["buffer_count"]:
+            self._RawModes[self._selected_RawMode_idx]["buffer_count"] = n
+            # needs camera reconfiguration
+            self._publish(newMode=True)
         self._AccessLock.unlock()
-        return g
 
     @property
-    def Binning(self):
+    def ROI(self):
+        return self._Snapshot.ROI
+
+    @ROI.setter
+    def ROI(self, roi):
+        roi = None if roi is None else tuple(roi)
         self._AccessLock.lock()
-        b = self._RawModes[self._selected_RawMode_idx]["binning"]
+        if roi != self._ROI:
+            self._ROI = roi
+            self._publish()
         self._AccessLock.unlock()
-        return b
+
+    @property
+    def Binning(self):
+        return self._Snapshot.RawMode["binning"]
 
     @property
     def ExposureTime(self):
-        self._AccessLock.lock()
-        t = self._camera_controls["ExposureTime"] / 1e6
-        self._AccessLock.unlock()
-        return t
+        return self._Snapshot.Controls["ExposureTime"] / 1e6
 
     @ExposureTime.setter
     def ExposureTime(self, t):
@@ -164,15 +285,12 @@ class CameraSettings:
         )
         if t_usec != self._camera_controls["ExposureTime"]:
             self._camera_controls["ExposureTime"] = t_usec
-            self._is_newControls = True
+            self._publish(newControls=True)
         self._AccessLock.unlock()
 
     @property
     def Gain(self):
-        self._AccessLock.lock()
-        g = self._camera_controls["AnalogueGain"]
-        self._AccessLock.unlock()
-        return g
+        return self._Snapshot.Controls["AnalogueGain"]
 
     @Gain.setter
     def Gain(self, g):
@@ -187,39 +305,13 @@ class CameraSettings:
         )
         if g != self._camera_controls["AnalogueGain"]:
             self._camera_controls["AnalogueGain"] = g
-            self._is_newControls = True
-        self._AccessLock.unlock()
-
-    @property
-    def is_newControls(self):
-        self._AccessLock.lock()
-        ret = self._is_newControls
-        self._AccessLock.unlock()
-        return ret
-
-    def reset_newControls(self):
-        self._AccessLock.lock()
-        self._is_newControls = False
-        self._AccessLock.unlock()
-
-    @property
-    def is_newMode(self):
-        self._AccessLock.lock()
-        ret = self._is_newMode
-        self._AccessLock.unlock()
-        return ret
-
-    def reset_newMode(self):
-        self._AccessLock.lock()
-        self._is_newMode = False
+            self._publish(newControls=True)
         self._AccessLock.unlock()
 
     @property
     def camera_controls(self):
-        self._AccessLock.lock()
-        ret = self._camera_controls
-        self._AccessLock.unlock()
-        return ret
+        """return copy of camera controls"""
+        return dict(self._Snapshot.Controls)
 
     def __str__(self):
         return f'CameraSettings: RawMode={self.RawMode}, CameraControls={self.camera_controls}'
@@ -246,9 +338,12 @@ class CameraControl(QtCore.QThread):
         # exposure loop control
         self.Sig_ActionExit = threading.Event()  # abort and exit exposure loop
         self.Sig_CaptureDone = threading.Event()
+        self.Sig_Wakeup = threading.Event()  # set together with Sig_ActionExit and Sig_CaptureDone
         # exposure loop in separate thread
         self.Sig_ActionExit.clear()
         self.Sig_CaptureDone.clear()
+        self.Sig_Wakeup.clear()
+        self._CaptureDoneTime = None
         # handshake with GUI
         self.Sig_GiveImage = threading.Event()
         self.Sig_GiveImage.clear()
@@ -259,9 +354,27 @@ class CameraControl(QtCore.QThread):
         self._FrameType = "Light"
         self._ImagesToRecord = 0
         self._ImagesRecorded = 0
+        self._DroppedFrames = 0
         self._Record = False
         self._SettingsLock = QtCore.QMutex()
         self._Ext = ".pfc"
+        self._SequenceExt = ".pfcs"
+        self._SERExt = ".ser"
+        self._Container = "sequence file"
+        self._Encoding = pifcap_image.ENCODING_RAW
+        self._RecordingRun = 0
+        self._Sequence = None
+        self._SequenceRun = None
+        # frame size and Bayer pattern of current SER video
+        self._SequenceGeometry = None
+        self.FrameWriter = None
+        self.FrameSelector = None
+        self.DiskMonitor = None
+        self.Timing = None
+        self._ExportTiming = False
+        self._FrameNumber = 0
+        # estimated file size per frame geometry
+        self._FileSizes = dict()
 
     def get_Cameras(self):
         """return list of available cameras"""
@@ -289,7 +402,14 @@ class CameraControl(QtCore.QThread):
             Rect = self.CamProps["PixelArrayActiveAreas"][0]
             self.CamProps["PixelArrayActiveAreas"] = (Rect.x, Rect.y, Rect.width, Rect.height)
         # raw modes
-        self.CameraSettings.available_RawModes = self.getRawCameraModes()
+        raw_modes = self.getRawCameraModes()
+        # default number of buffers per raw mode
+        BufferCount = self.parent.Settings.get('camera hardware', 'buffer count')
+        BufferMemory = self.parent.Settings.get('camera hardware', 'buffer memory limit') * 1024 * 1024
+        for raw_mode in raw_modes:
+            FrameBytes = raw_mode["size"][0] * raw_mode["size"][1] * (2 if raw_mode["bit_depth"] > 8 else 1)
+            raw_mode["buffer_count"] = max(2, min(BufferCount, BufferMemory // FrameBytes))
+        self.CameraSettings.available_RawModes = raw_modes
         # some cameras need a restart after each exposure
         force_Restart = self.parent.Settings.get('camera hardware', 'force camera restarts')
         if force_Restart == "yes":
@@ -301,6 +421,42 @@ class CameraControl(QtCore.QThread):
         else:
             # "auto":
             self.needs_Restarts = self.CamProps["Model"] in ["imx290", "imx519"]
+        # frame writer
+        self.DiskMonitor = writer.DiskSpaceMonitor(
+            Folder=self._Folder,
+            Period=self.parent.Settings.get('frame writer', 'disk space refresh period'),
+            RefreshBytes=self.parent.Settings.get('frame writer', 'disk space refresh amount') * 1024 * 1024,
+        )
+        self.DiskMonitor.start()
+        self.Timing = timing.PipelineTiming(
+            WindowLength=self.parent.Settings.get('pipeline timing', 'window length'),
+        )
+        self._ExportTiming = self.parent.Settings.get('pipeline timing', 'export CSV')
+        self.FrameWriter = writer.FrameWriter(
+            QueueLength=self.parent.Settings.get('frame writer', 'queue length'),
+            nThreads=self.parent.Settings.get('frame writer', 'writer threads'),
+            Policy=self.parent.Settings.get('frame writer', 'queue full policy'),
+            DiskMonitor=self.DiskMonitor,
+            Timing=self.Timing,
+        )
+        self.FrameWriter.start()
+        # frame quality scoring and selection
+        SelectionMode = self.parent.Settings.get('frame selection', 'mode')
+        if SelectionMode != 'off':
+            self.FrameSelector = quality.FrameSelector(
+                FrameWriter=self.FrameWriter,
+                Mode=SelectionMode,
+                Threshold=self.parent.Settings.get('frame selection', 'threshold'),
+                KeepPercentage=self.parent.Settings.get('frame selection', 'keep percentage'),
+                WindowLength=self.parent.Settings.get('frame selection', 'window length'),
+                Decimation=self.parent.Settings.get('frame selection', 'decimation'),
+                nThreads=self.parent.Settings.get('frame selection', 'worker threads'),
+            )
+        self._Container = self.parent.Settings.get('frame writer', 'file container')
+        if self.parent.Settings.get('frame writer', 'pixel encoding') == 'packed':
+            self._Encoding = pifcap_image.ENCODING_PACKED
+        else:
+            self._Encoding = pifcap_image.ENCODING_RAW
         # start exposure loop
         self.Sig_ActionExit.clear()
         self.start()
@@ -317,6 +473,7 @@ class CameraControl(QtCore.QThread):
         # stop exposure loop
         if self.isRunning():
             self.Sig_ActionExit.set()
+            self.Sig_Wakeup.set()
             self.wait()  # wait until exposure loop exits
         # close picam2
         if self.picam2 is not None:
@@ -324,6 +481,20 @@ class CameraControl(QtCore.QThread):
                 self.picam2.stop_()
             self.picam2.close()
         self.picam2 = None
+        # write all pending frames
+        if self.FrameWriter is not None:
+            self._close_Sequence()
+            if self.FrameSelector is not None:
+                self.FrameSelector.shutdown()
+                self.FrameSelector = None
+            self.FrameWriter.stop(flush=True)
+            self.FrameWriter = None
+        if self.DiskMonitor is not None:
+            self.DiskMonitor.stop()
+            self.DiskMonitor = None
+        if self.Timing is not None:
+            self.Timing.stop_Session()
+            self.Timing = None
         # reset states
         self.CamProps = dict()
         self.CameraSettings = CameraSettings()
@@ -333,7 +504,8 @@ class CameraControl(QtCore.QThread):
         self.parent.log_Info(f'reconfiguring camera')
         config = self.picam2.create_still_configuration(
             queue=DoFastExposure,
-            buffer_count=2 if DoFastExposure else 1  # need at least 2 buffer for queueing
+            # need at least 2 buffer for queueing
+            buffer_count=max(2, RawMode.get("buffer_count", 2)) if DoFastExposure else 1
         )
         # we do not need the main stream and configure it to smaller size to save memory
         config["main"]["size"] = (240, 190)
@@ -348,8 +520,60 @@ class CameraControl(QtCore.QThread):
         # set still configuration
         self.picam2.configure(config)
 
+    def get_SensorModeList(self):
+        """return list of sensor formats and sizes
+
+        This does not need a camera configuration per sensor mode (different to picam2.sensor_modes).
+        """
+        try:
+            RawConfig = self.picam2.camera.generate_configuration([libcamera.StreamRole.Raw])
+            formats = RawConfig.at(0).formats
+            return sorted(
+                [str(pix), sorted([(size.width, size.height) for size in formats.sizes(pix)])]
+                for pix in formats.pixel_formats
+            )
+        except Exception:
+            return self.picam2.sensor_modes
+
+    def get_RawModesCacheKey(self):
+        """return key identifying camera model, sensor modes, software versions and relevant settings
+        """
+        picamera2_version, libcamera_version = get_SoftwareVersions()
+        KeyData = json.dumps(
+            [
+                self.CamProps["Model"],
+                self.get_SensorModeList(),
+                picamera2_version,
+                libcamera_version,
+                self.parent.Settings.get('camera hardware', 'do hardware specific adjustments'),
+            ],
+            default=str, sort_keys=True,
+        )
+        return hashlib.sha1(KeyData.encode("utf-8")).hexdigest()
+
     def getRawCameraModes(self):
         """get list of usable raw camera modes
+
+        Raw modes and their limits are cached on disk. Discovery needs a camera reconfiguration per mode
+        and is only done when the cache is invalid or rediscovery is forced in the settings.
+        """
+        Model = self.CamProps["Model"]
+        CacheKey = self.get_RawModesCacheKey()
+        if not self.parent.Settings.get('camera hardware', 'force raw mode rediscovery'):
+            raw_modes = load_RawModesCache(Model, CacheKey)
+            if raw_modes is not None:
+                self.parent.log_Info("Using cached raw modes.")
+                return raw_modes
+        self.parent.log_Info("Discovering raw modes.")
+        raw_modes = self.discoverRawCameraModes()
+        try:
+            store_RawModesCache(Model, CacheKey, raw_modes)
+        except OSError as e:
+            self.parent.log_Warn(f'Can not store raw modes in cache: {e}')
+        return raw_modes
+
+    def discoverRawCameraModes(self):
+        """get list of usable raw camera modes from camera
         """
         sensor_modes = self.picam2.sensor_modes
         raw_modes = []
@@ -474,13 +698,30 @@ class CameraControl(QtCore.QThread):
         self._ImagesToRecord = ImagesToRecord
         self._FrameType = FrameType
         self._SettingsLock.unlock()
+        if self.DiskMonitor is not None:
+            self.DiskMonitor.set_Folder(Folder)
 
     def Recording(self, Record):
         self._SettingsLock.lock()
         self._Record = Record
         if Record:
             self._ImagesRecorded = 0
+            self._DroppedFrames = 0
+            self._RecordingRun += 1
+            if self.FrameWriter is not None:
+                self.FrameWriter.reset_Stats()
+            if self.FrameSelector is not None:
+                self.FrameSelector.reset_Stats()
+            if (self.Timing is not None) and self._ExportTiming:
+                TimeStamp = datetime.datetime.now().strftime("%y%m%dT%H%M%S")
+                try:
+                    self.Timing.start_Session(os.path.join(self._Folder, f'{self._Prefix}-{TimeStamp}-timing.csv'))
+                except OSError as e:
+                    self.parent.log_Warn(f'Can not write timing CSV: {e}')
         self._SettingsLock.unlock()
+        if (not Record) and (self.Timing is not None):
+            # recording stopped or finished: timing CSV gets closed when all its frames are written
+            self.Timing.stop_Session()
 
     def run(self):
         """exposure loop
@@ -488,6 +729,11 @@ class CameraControl(QtCore.QThread):
         Made to run in a separate thread.
         """
         DoFastExposure = True
+        # sensor timestamp of previous frame for dropped frame detection
+        PrevSensorTimestamp = None
+        # versions of camera settings currently active
+        ModeVersion = None
+        ControlsVersion = None
         while True:
             if self.Sig_ActionExit.is_set():
                 # exit exposure loop
@@ -496,45 +742,52 @@ class CameraControl(QtCore.QThread):
             # picam2 needs to be open!
             if self.picam2 is None:
                 raise RuntimeError("trying to make an exposure without camera opened")
+            # camera settings for this frame
+            Settings = self.CameraSettings.snapshot()
             # need a camera stop/start when something has changed on camera configuration
-            if self.CameraSettings.is_newMode or self.needs_Restarts:
+            if (Settings.ModeVersion != ModeVersion) or self.needs_Restarts:
                 if self.picam2.started:
                     #self.parent.log_Info(f'Stopping camera for deeper reconfiguration.')
                     self.picam2.stop_()
+                PrevSensorTimestamp = None
                 # change of DoFastExposure needs a configuration change
-                self.CameraSettings.reset_newMode()
-                self.reconfigure_Camera(RawMode=self.CameraSettings.RawMode, DoFastExposure=DoFastExposure)
+                ModeVersion = Settings.ModeVersion
+                self.reconfigure_Camera(RawMode=Settings.RawMode, DoFastExposure=DoFastExposure)
+                # controls need to be set again after configuration
+                ControlsVersion = None
             # changing exposure time or analogue gain can be done with camera running
-            if self.CameraSettings.is_newControls:
+            if Settings.ControlsVersion != ControlsVersion:
                 # change camera controls
-                self.CameraSettings.reset_newControls()
-                self.picam2.set_controls(self.CameraSettings.camera_controls)
+                ControlsVersion = Settings.ControlsVersion
+                self.picam2.set_controls(dict(Settings.Controls))
             # start camera if not already running
             if not self.picam2.started:
                 self.picam2.start()
                 #self.parent.log_Info(f'Camera started.')
+            # get (non-blocking!) frame and meta data
+            self.Sig_CaptureDone.clear()  # set by on_CaptureFinished callback
+            self.Sig_Wakeup.clear()
             # last chance to exit or abort before doing exposure
             if self.Sig_ActionExit.is_set():
                 # exit exposure loop
                 self.picam2.stop_()
                 return
-            # get (non-blocking!) frame and meta data
-            self.Sig_CaptureDone.clear()  # set by on_CaptureFinished callback
-            ExpectedEndOfExposure = time.time() + self.CameraSettings.ExposureTime
             job = self.picam2.capture_arrays(["raw"], wait=False, signal_function=self.on_CaptureFinished)
-            PollingPeriod_s = 0.2
-            while ExpectedEndOfExposure - time.time() > PollingPeriod_s:
-                # allow to close camera
-                if self.Sig_ActionExit.is_set():
-                    # exit exposure loop
-                    self.picam2.stop_()
-                    return
-                # allow exposure to finish earlier than expected (for instance when in fast exposure mode)
-                if self.Sig_CaptureDone.is_set():
-                    break
-                time.sleep(PollingPeriod_s)
+            # sleep until exposure is done or camera gets closed
+            self.Sig_Wakeup.wait()
+            WakeupTime = time.perf_counter()
+            # allow to close camera
+            if self.Sig_ActionExit.is_set():
+                # exit exposure loop
+                self.picam2.stop_()
+                return
             # get frame and its metadata
             (array, ), metadata = self.picam2.wait(job)
+            FrameNumber = self._FrameNumber
+            self._FrameNumber += 1
+            self.Timing.mark(FrameNumber, "exposure end", t=self._CaptureDoneTime)
+            self.Timing.mark(FrameNumber, "buffer receipt")
+            WakeupLatency = WakeupTime - self._CaptureDoneTime
             DateEnd = datetime.datetime.now(datetime.timezone.utc)
             #self.parent.log_Info('got exposed frame')
             # last chance to exit or abort before sending frame
@@ -545,49 +798,140 @@ class CameraControl(QtCore.QThread):
             if not DoFastExposure:
                 # in normal exposure mode the camera needs to be started with exposure command
                 self.picam2.stop()
+            # frames dropped by the camera pipeline between this and the previous frame
+            SensorTimestamp = metadata.get("SensorTimestamp", None)
+            FrameDuration = metadata.get("FrameDuration", None)
+            DroppedBefore = 0
+            if (PrevSensorTimestamp is not None) and (SensorTimestamp is not None) and FrameDuration:
+                DroppedBefore = max(0, int(round((SensorTimestamp - PrevSensorTimestamp) / (FrameDuration * 1000))) - 1)
+            PrevSensorTimestamp = SensorTimestamp if DoFastExposure else None
+            self._SettingsLock.lock()
+            self._DroppedFrames += DroppedBefore
+            DroppedFrames = self._DroppedFrames
+            self._SettingsLock.unlock()
             # save image
             metadata = {
                 k: metadata.get(k, None) 
                 for k in [
                     'SensorBlackLevels', 'Lux', 'FrameDuration', 'DigitalGain',
-                    'AnalogueGain', 'ScalerCrop', 'ExposureTime'
+                    'AnalogueGain', 'ScalerCrop', 'ExposureTime', 'SensorTimestamp',
                 ]
             }
             metadata["DateEnd"] = DateEnd
             metadata["FrameType"] = self._FrameType
             metadata["CameraModel"] = self.CamProps["Model"]
             metadata["UnitCellSize"] = self.CamProps["UnitCellSize"]
-            metadata["Binning"] = self.CameraSettings.Binning
+            metadata["Binning"] = Settings.RawMode["binning"]
+            metadata["WakeupLatency"] = WakeupLatency
+            metadata["DroppedBefore"] = DroppedBefore
+            metadata["DroppedFrames"] = DroppedFrames
+            metadata["FrameNumber"] = FrameNumber
+            self.Timing.mark(FrameNumber, "metadata")
             self.on_Image(
                 array=array, metadata=metadata, 
-                format=self.picam2.camera_configuration()["raw"]["format"]
+                format=self.picam2.camera_configuration()["raw"]["format"],
+                ROI=Settings.ROI,
             )
 
 
     def on_CaptureFinished(self, Job):
         """callback function for capture done
         """
+        self._CaptureDoneTime = time.perf_counter()
         self.Sig_CaptureDone.set()
+        self.Sig_Wakeup.set()
 
-    def on_Image(self, array, metadata, format):
+    def get_FrameSink(self):
+        """return frame selector when frames get scored, frame writer otherwise
+        """
+        return self.FrameWriter if self.FrameSelector is None else self.FrameSelector
+
+    def _close_Sequence(self):
+        """close sequence file of recording run after all its frames are written
+        """
+        if self._Sequence is not None:
+            self.get_FrameSink().close(self._Sequence)
+            self._Sequence = None
+
+    def crop_ROI(self, array, metadata, format, ROI):
+        """crop frame to region of interest
+
+        The crop is a view (no copy) of the raw array. The ROI offset and size get stored in the metadata.
+
+        Args:
+            ROI: region of interest (x, y, width, height) or None for full frame
+
+        Returns:
+            (cropped array, metadata)
+        """
+        if ROI is None:
+            return array, metadata
+        # raw array has shape (rows, bytes per row)
+        BytesPerPixel = 2 if int(re.search("[0-9]+", format).group()) > 8 else 1
+        Height, Width = array.shape[0], array.shape[1] // BytesPerPixel
+        x, y, w, h = ROI
+        x = min(max(x, 0), Width)
+        y = min(max(y, 0), Height)
+        w = min(w, Width - x)
+        h = min(h, Height - y)
+        if (w <= 0) or (h <= 0):
+            return array, metadata
+        metadata = dict(metadata)
+        metadata["ROI"] = (x, y, w, h)
+        return array[y:y + h, x * BytesPerPixel:(x + w) * BytesPerPixel], metadata
+
+    def on_Image(self, array, metadata, format, ROI=None):
+        # store only region of interest
+        SaveArray, SaveMetadata = self.crop_ROI(array, metadata, format, ROI)
         self._SettingsLock.lock()
-        Img = pifcap_image.Image(array=array, metadata=metadata, format=format, comment=self._Comment)
+        Img = pifcap_image.Image(
+            array=SaveArray, metadata=SaveMetadata, format=format, comment=self._Comment, encoding=self._Encoding,
+        )
         Record = self._Record
         ImagesRemain = self._ImagesToRecord - self._ImagesRecorded
         Folder = self._Folder
+        RecordingRun = self._RecordingRun
         self._SettingsLock.unlock()
+        # recording run stopped or restarted: finish its sequence file
+        if (self._Sequence is not None) and not (Record and (self._SequenceRun == RecordingRun)):
+            self._close_Sequence()
         if Record and (ImagesRemain > 0):
             TimeStamp = datetime.datetime.now().strftime("%y%m%dT%H%M%S%f")[:16]
             self._SettingsLock.lock()
             FileName = os.path.join(Folder, f'{self._Prefix}-{TimeStamp}{self._Ext}')
+            SequenceName = os.path.join(Folder, f'{self._Prefix}-{TimeStamp}{self._SequenceExt}')
+            SERName = os.path.join(Folder, f'{self._Prefix}-{TimeStamp}{self._SERExt}')
             self._ImagesRecorded += 1
-            if self._ImagesRecorded >= self._ImagesToRecord:
+            is_LastImage = self._ImagesRecorded >= self._ImagesToRecord
+            if is_LastImage:
                 self.sigRecordingFinished.emit()
                 self._Record = False
             self._SettingsLock.unlock()
-            Img.save(filename=FileName)
-        disc_total, disc_used, disc_free = shutil.disk_usage(Folder)
-        disc_free_images = disc_free // Img.estimate_FileSize()
+            # scoring and writing is done in worker threads
+            if self._Container in ("sequence file", "SER video"):
+                Geometry = (SaveArray.shape, format, serwriter.get_ColorID(format, SaveMetadata.get("ROI", None)))
+                if (self._Sequence is not None) and (self._Container == "SER video") and \
+                        (Geometry != self._SequenceGeometry):
+                    # ROI changed: SER videos need equal frames, continue in a new file
+                    self._close_Sequence()
+                if self._Sequence is None:
+                    if self._Container == "SER video":
+                        self._Sequence = serwriter.SERWriter(SERName)
+                    else:
+                        self._Sequence = pifcap_sequence.SequenceWriter(SequenceName)
+                    self._SequenceRun = RecordingRun
+                    self._SequenceGeometry = Geometry
+                self.get_FrameSink().put(Img, self._Sequence)
+                if is_LastImage:
+                    self._close_Sequence()
+            else:
+                self.get_FrameSink().put(Img, FileName)
+        disc_free = self.DiskMonitor.get_Free()
+        # file size estimation is done once per frame geometry
+        FileSizeKey = (Img.array.shape, Img.array.dtype.str, Img.format, Img.encoding)
+        if FileSizeKey not in self._FileSizes:
+            self._FileSizes[FileSizeKey] = Img.estimate_FileSize()
+        disc_free_images = disc_free // self._FileSizes[FileSizeKey]
         # send preview image to GUI
         if self.Sig_GiveImage.is_set():
             self.sigImage.emit({
@@ -598,6 +942,8 @@ class CameraControl(QtCore.QThread):
                     "ImagesRecorded": self._ImagesRecorded,
                     "disc_free": disc_free,
                     "disc_free_images": disc_free_images,
+                    "WriterStats": self.FrameWriter.get_Stats(),
+                    "SelectorStats": None if self.FrameSelector is None else self.FrameSelector.get_Stats(),
                 },
             })
             self.Sig_GiveImage.clear()
@@ -0,0 +1,186 @@
+"""
+watching a folder for completely written files
+
+pifcap writes files under a hidden temporary name and renames them when complete (see
+`pifcap_image.get_TempName`), so every visible file is final. On Linux the kernel reports renamed
+files with inotify (accessed with ctypes, no extra package needed). Where inotify is not available the
+folder gets polled with os.scandir. Hidden files are ignored. Memory use is bounded by the folder
+content, not by the number of files seen over time.
+"""
+
+import os
+import sys
+import fnmatch
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+# wd, mask, cookie, len (followed by len bytes name)
+_InotifyEvent = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """report files in a folder when they get closed after writing or moved into the folder
+    """
+
+    def __init__(self, Folder):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.Folder = Folder
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(Folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f'inotify_add_watch failed for {Folder}')
+
+    def wait(self, timeout=None):
+        """wait for files
+
+        Args:
+            timeout: maximum waiting time in seconds, None waits forever
+
+        Returns:
+            list of file names (without folder); None when events got lost and the folder needs a rescan
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return list()
+        Names = list()
+        Overflow = False
+        while True:
+            try:
+                Buffer = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _InotifyEvent.size <= len(Buffer):
+                wd, mask, cookie, length = _InotifyEvent.unpack_from(Buffer, offset)
+                offset += _InotifyEvent.size
+                if mask & IN_Q_OVERFLOW:
+                    Overflow = True
+                elif length > 0:
+                    Names.append(os.fsdecode(Buffer[offset:offset + length].rstrip(b"\0")))
+                offset += length
+        return None if Overflow else Names
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """report files in a folder when they appear
+
+    Files are expected to be renamed into the folder when complete, so they are reported at the first
+    scan which sees them.
+    """
+
+    def __init__(self, Folder, Period=1.0):
+        self.Folder = Folder
+        self.Period = Period
+        # names of files present at last scan
+        self._Files = set()
+        # files existing now are not reported
+        self._scan()
+        self._LastScan = time.monotonic()
+
+    def _scan(self):
+        """scan folder and return names of files not present at last scan"""
+        with os.scandir(self.Folder) as it:
+            Files = set()
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        Files.add(entry.name)
+                except OSError:
+                    # removed in the meantime
+                    continue
+        Names = [name for name in Files if name not in self._Files]
+        # forget files which are gone
+        self._Files = Files
+        return Names
+
+    def wait(self, timeout=None):
+        """wait for files
+
+        Args:
+            timeout: maximum waiting time in seconds, None waits for next scan
+
+        Returns:
+            list of file names (without folder)
+        """
+        delay = self._LastScan + self.Period - time.monotonic()
+        if (timeout is not None) and (timeout < delay):
+            time.sleep(max(timeout, 0))
+            return list()
+        time.sleep(max(delay, 0))
+        self._LastScan = time.monotonic()
+        return self._scan()
+
+    def close(self):
+        pass
+
+
+class FileWatcher:
+    """report new files matching a pattern like "/path/*.pfc"
+
+    The folder part of the pattern must not contain wildcards.
+    """
+
+    def __init__(self, Pattern, PollingPeriod=1.0, ForcePolling=False):
+        self.Folder, self.Pattern = os.path.split(Pattern)
+        self.Folder = self.Folder or "."
+        if any(c in self.Folder for c in "*?["):
+            raise ValueError(f'can not watch folder pattern {self.Folder}')
+        self._Watcher = None
+        if not ForcePolling:
+            try:
+                self._Watcher = InotifyWatcher(self.Folder)
+            except (OSError, AttributeError):
+                # no inotify: fall back to polling
+                pass
+        self.is_Polling = self._Watcher is None
+        if self.is_Polling:
+            self._Watcher = PollingWatcher(self.Folder, Period=PollingPeriod)
+
+    def scan(self):
+        """return all existing files matching the pattern"""
+        with os.scandir(self.Folder) as it:
+            return [
+                os.path.join(self.Folder, entry.name) for entry in it
+                if self._is_Matching(entry.name) and entry.is_file()
+            ]
+
+    def _is_Matching(self, name):
+        """check if file name matches the pattern; hidden files (being written) never match"""
+        return (not name.startswith(".")) and fnmatch.fnmatch(name, self.Pattern)
+
+    def wait(self, timeout=None):
+        """wait for new or completely written files matching the pattern
+
+        Args:
+            timeout: maximum waiting time in seconds
+
+        Returns:
+            list of file names
+        """
+        Names = self._Watcher.wait(timeout)
+        if Names is None:
+            # lost events
+            return self.scan()
+        return [os.path.join(self.Folder, name) for name in Names if self._is_Matching(name)]
+
+    def close(self):
+        self._Watcher.close()
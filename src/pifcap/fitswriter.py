@@ -0,0 +1,503 @@
+"""
+fast native FITS writer for pifcap images
+
+The FITS header is built once per sequence of frames with equal geometry and camera settings; per frame
+only the cards of frame dependent keywords get patched. Pixel data are left adjusted, offset by BZERO
+and converted to big endian block by block into a reusable buffer without temporary full frame arrays.
+Header and data get written with one system call.
+
+`FITSCubeWriter` streams all frames of a recording sequence into one file, either as 3-dim cube or as
+multi-extension file, followed by a binary table with the timestamps of the frames.
+
+astropy is not needed here; it is optional for verification of written files.
+"""
+
+import os
+import datetime
+import numpy as np
+
+from . import pifcap_image
+
+# FITS block size
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+# characters of a quoted string value in a card after "KEYWORD = " (quotes included)
+STRING_SIZE = CARD_SIZE - 10
+# rows per conversion block, small enough to stay in CPU cache
+BlockRows = 32
+
+# keywords which change from frame to frame
+DynamicKeys = ("EXPTIME", "DATE-OBS", "DATE-END", "GAIN")
+
+
+def get_Cards(img):
+    """return list of (keyword, value, comment) describing a pifcap image
+
+    Data description keywords (SIMPLE, BITPIX, NAXIS, ...) are not included.
+
+    Args:
+        img: pifcap_image.Image
+    """
+    metadata = img.metadata
+    BayerPattern, bit_depth = pifcap_image.parse_Format(img.format)
+    bit_pix = 16 if bit_depth > 8 else 8
+    Cards = list()
+    if bit_pix == 16:
+        Cards.append(("BZERO", 2 ** (bit_pix - 1), "offset data range"))
+        Cards.append(("BSCALE", 1, "default scaling factor"))
+    Cards += [
+        ("ROWORDER", "TOP-DOWN", "Row order"),
+        ("INSTRUME", metadata["CameraModel"], "CCD Name"),
+        ("EXPTIME", metadata["ExposureTime"]/1e6, "[s] Total Exposure Time"),
+        (
+            "DATE-OBS",
+            (metadata["DateEnd"] - datetime.timedelta(seconds=metadata["ExposureTime"]/1e6)).isoformat(timespec="milliseconds"),
+            "UTC time of observation start"
+        ),
+        ("DATE-END", metadata["DateEnd"].isoformat(timespec="milliseconds"), "UTC time at end of observation"),
+        ("PIXSIZE1", metadata["UnitCellSize"][0] / 1e3, "[um] Pixel Size 1"),
+        ("PIXSIZE2", metadata["UnitCellSize"][1] / 1e3, "[um] Pixel Size 2"),
+        ("XBINNING", metadata["Binning"][0], "Binning factor in width"),
+        ("YBINNING", metadata["Binning"][1], "Binning factor in height"),
+        ("XPIXSZ", metadata["UnitCellSize"][0] / 1e3 * metadata["Binning"][0], "[um] X binned pixel size"),
+        ("YPIXSZ", metadata["UnitCellSize"][1] / 1e3 * metadata["Binning"][1], "[um] Y binned pixel size"),
+        ("FRAME", metadata["FrameType"], "Frame Type"),
+        ("IMAGETYP", metadata["FrameType"] + " Frame", "Frame Type"),
+        ("GAIN", metadata["AnalogueGain"], "Gain"),
+    ]
+    # region of interest
+    ROI = metadata.get("ROI", None)
+    if ROI is not None:
+        Cards.append(("XORGSUBF", ROI[0], "[px] X origin of subframe"))
+        Cards.append(("YORGSUBF", ROI[1], "[px] Y origin of subframe"))
+    if BayerPattern is not None:
+        Cards.append(("XBAYROFF", 0 if ROI is None else ROI[0] % 2, "[px] X offset of Bayer array"))
+        Cards.append(("YBAYROFF", 0 if ROI is None else ROI[1] % 2, "[px] Y offset of Bayer array"))
+        Cards.append(("BAYERPAT", BayerPattern, "Bayer color pattern"))
+    SensorBlackLevels = metadata.get("SensorBlackLevels", None)
+    if (SensorBlackLevels is not None) and (len(SensorBlackLevels) == 4):
+        # according to picamera2 documentation:
+        #   "The black levels of the raw sensor image. This
+        #    control appears only in captured image
+        #    metadata and is read-only. One value is
+        #    reported for each of the four Bayer channels,
+        #    scaled up as if the full pixel range were 16 bits
+        #    (so 4096 represents a black level of 16 in 10-
+        #    bit raw data)."
+        # When image data is stored as 16bit it is not needed to scale SensorBlackLevels again.
+        # But when we store image with 8bit/pixel we need to divide by 2**8.
+        SensorBlackLevelScaling = 2 ** (bit_pix - 16)
+        for i in range(4):
+            Cards.append((f'OFFSET_{i}', SensorBlackLevels[i] * SensorBlackLevelScaling, f'[DN] Sensor Black Level {i}'))
+    if img.comment:
+        Cards.append(("COMMENT", img.comment, ""))
+    for name in metadata.get("Calibration", ()):
+        Cards.append(("HISTORY", f'calibrated with {name}', ""))
+    return Cards
+
+
+def fit_String(value):
+    """return string value shortened to fit into one header card
+
+    Quotes count twice because they get doubled in the card.
+    """
+    s = str(value)
+    n = 0
+    for i, c in enumerate(s):
+        n += 2 if c == "'" else 1
+        if n > STRING_SIZE - 2:
+            return s[:i]
+    return s
+
+
+def format_Card(key, value, comment=""):
+    """return 80 bytes FITS header card
+
+    Long string values get shortened (see `fit_String`), comments get shortened or dropped.
+    """
+    if key in ("COMMENT", "HISTORY", ""):
+        return f'{key:8s}{value}'[:CARD_SIZE].ljust(CARD_SIZE).encode("ascii", "replace")
+    if isinstance(value, (bool, np.bool_)):
+        v = f'{"T" if value else "F":>20s}'
+    elif isinstance(value, (int, np.integer)):
+        v = f'{value:>20d}'
+    elif isinstance(value, (float, np.floating)):
+        v = repr(float(value)).upper()
+        if len(v) > 20:
+            v = f'{float(value):.14G}'
+        v = f'{v:>20s}'
+    else:
+        # quoted string, at least 8 characters
+        s = fit_String(value).replace("'", "''")
+        v = f"'{s:8s}'"
+        v = f'{v:20s}'
+    card = f'{key:8s}= {v}'
+    if comment and (len(card) + 4 <= CARD_SIZE):
+        card += f' / {comment}'
+    return card[:CARD_SIZE].ljust(CARD_SIZE).encode("ascii", "replace")
+
+
+def _pad(n, block=BLOCK_SIZE):
+    """return number of bytes needed to fill n up to a multiple of block"""
+    return (block - n % block) % block
+
+
+def get_DataCards(shape, bit_pix, Extension=False):
+    """return cards describing the data array of an HDU
+
+    Args:
+        shape: array shape, slowest varying axis first (numpy order)
+        bit_pix: BITPIX
+        Extension: IMAGE extension instead of primary HDU
+    """
+    if Extension:
+        Cards = [("XTENSION", "IMAGE", "image extension")]
+    else:
+        Cards = [("SIMPLE", True, "conforms to FITS standard")]
+    Cards += [
+        ("BITPIX", bit_pix, "array data type"),
+        ("NAXIS", len(shape), "number of array dimensions"),
+    ]
+    Cards += [(f'NAXIS{i + 1}', n, "") for i, n in enumerate(reversed(shape))]
+    if Extension:
+        Cards += [
+            ("PCOUNT", 0, "number of parameter bytes"),
+            ("GCOUNT", 1, "number of groups"),
+        ]
+    return Cards
+
+
+def format_Header(Cards):
+    """return header bytes of cards, terminated with END and padded to full blocks"""
+    Header = b"".join(format_Card(*c) for c in Cards) + b"END".ljust(CARD_SIZE)
+    return Header + b" " * _pad(len(Header))
+
+
+def write_Buffers(fd, Buffers):
+    """write all buffers to file descriptor
+
+    Returns:
+        number of bytes written
+    """
+    nBytes = sum(memoryview(b).nbytes for b in Buffers)
+    if hasattr(os, "writev"):
+        written = os.writev(fd, Buffers)
+    else:
+        written = sum(os.write(fd, b) for b in Buffers)
+    if written < nBytes:
+        # short write (large files): write the rest
+        Remaining = b"".join(bytes(b) for b in Buffers)[written:]
+        while Remaining:
+            n = os.write(fd, Remaining)
+            Remaining = Remaining[n:]
+    return nBytes
+
+
+class FITSWriter:
+    """native FITS writer, reusing header template and data buffer for frames of a sequence
+    """
+
+    def __init__(self):
+        # static cards the template was built for
+        self._StaticKey = None
+        self._Template = None
+        # card index of dynamic keywords in template
+        self._DynamicCards = dict()
+        # FITS data buffer and scratch block for conversion
+        self._Buffer = None
+        self._Scratch = None
+
+    def _get_Header(self, img, shape, bit_pix, Extension=False):
+        """return header bytes, rebuilt only when static keywords change"""
+        Cards = get_Cards(img)
+        StaticKey = (shape, bit_pix, Extension) + tuple(c for c in Cards if c[0] not in DynamicKeys)
+        if StaticKey != self._StaticKey:
+            Cards = get_DataCards(shape, bit_pix, Extension=Extension) + Cards
+            self._DynamicCards = {c[0]: idx for idx, c in enumerate(Cards) if c[0] in DynamicKeys}
+            self._Template = bytearray(format_Header(Cards))
+            self._StaticKey = StaticKey
+        else:
+            # patch frame dependent cards only
+            for key, value, comment in Cards:
+                idx = self._DynamicCards.get(key, None)
+                if idx is not None:
+                    self._Template[idx * CARD_SIZE:(idx + 1) * CARD_SIZE] = format_Card(key, value, comment)
+        return self._Template
+
+    def encode_Data(self, img):
+        """convert pixel data to FITS representation in reusable buffer
+
+        Rows are processed in small blocks: left adjust and BZERO offset happen in place in a cache
+        resident scratch block which is then copied with byte swapping into the output buffer.
+
+        Returns:
+            (array with FITS data, BITPIX)
+        """
+        BayerPattern, bit_depth = pifcap_image.parse_Format(img.format)
+        if bit_depth > 8:
+            bit_pix = 16
+            array = img.array.view(np.uint16)
+            Dtype = np.dtype(">u2")
+        else:
+            bit_pix = 8
+            array = img.array.view(np.uint8)
+            Dtype = np.dtype("u1")
+        shift = bit_pix - bit_depth
+        if (self._Buffer is None) or (self._Buffer.shape != array.shape) or (self._Buffer.dtype != Dtype):
+            self._Buffer = np.empty(array.shape, dtype=Dtype)
+            self._Scratch = np.empty((BlockRows, array.shape[1]), dtype=array.dtype)
+        for row in range(0, array.shape[0], BlockRows):
+            n = min(BlockRows, array.shape[0] - row)
+            Scratch = self._Scratch[:n]
+            np.left_shift(array[row:row + n], shift, out=Scratch)
+            if bit_pix == 16:
+                # subtract BZERO = 2**15 by flipping the sign bit
+                np.bitwise_xor(Scratch, np.uint16(0x8000), out=Scratch)
+            # casting to big endian buffer does the byte swap
+            np.copyto(self._Buffer[row:row + n], Scratch)
+        return self._Buffer, bit_pix
+
+    def encode_HDU(self, img, Extension=False):
+        """return list of buffers (header, data, padding) of a complete HDU
+
+        The buffers are reused by the next call.
+
+        Args:
+            img: pifcap_image.Image
+            Extension: IMAGE extension instead of primary HDU
+        """
+        Data, bit_pix = self.encode_Data(img)
+        Header = self._get_Header(img, Data.shape, bit_pix, Extension=Extension)
+        return [Header, Data.data, bytes(_pad(Data.nbytes))]
+
+    def write(self, img, output_filename):
+        """write pifcap image to FITS file
+
+        Args:
+            img: pifcap_image.Image
+            output_filename: name of FITS file
+
+        Returns:
+            number of bytes written
+        """
+        Buffers = self.encode_HDU(img)
+        fd = os.open(output_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            return write_Buffers(fd, Buffers)
+        finally:
+            os.close(fd)
+
+
+def _get_DateObs(metadata):
+    """return UTC datetime of exposure start"""
+    return metadata["DateEnd"] - datetime.timedelta(seconds=metadata["ExposureTime"] / 1e6)
+
+
+class FITSCubeWriter:
+    """stream frames of one recording sequence into a single FITS file
+
+    All frames must have the same raw format and size. Container "cube" writes a 3-dim primary array
+    (NAXIS3 is the number of frames, patched when closing), container "mef" writes an empty primary HDU
+    followed by one IMAGE extension per frame. Both end with a BINTABLE extension "TIMESTAMPS" holding
+    frame number, start time and exposure time of every frame. Only one frame is in memory at a time.
+    """
+
+    Containers = ("cube", "mef")
+
+    # columns of timestamp table: name, numpy dtype, TFORM, TUNIT
+    TimestampColumns = (
+        ("FRAME", ">i4", "J", ""),
+        ("DATE-OBS", "S32", "32A", ""),
+        ("TIMESTAMP", ">f8", "D", "s"),
+        ("EXPTIME", ">f8", "D", "s"),
+    )
+
+    def __init__(self, filename, Container="cube"):
+        if Container not in self.Containers:
+            raise ValueError(f'unknown FITS container {Container}')
+        self.filename = filename
+        self.Container = Container
+        self._Writer = FITSWriter()
+        self._fd = None
+        self._closed = False
+        # (shape, BITPIX) of first frame
+        self._Geometry = None
+        # cube: number of data bytes and header cards to patch at close
+        self._DataBytes = 0
+        self._PatchCards = dict()
+        self._LastCards = None
+        # one small tuple per frame
+        self._Timestamps = list()
+
+    def __len__(self):
+        return len(self._Timestamps)
+
+    def _open(self, img, shape, bit_pix):
+        """create file and write primary header"""
+        self._fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self._Geometry = (shape, bit_pix)
+        if self.Container == "cube":
+            # NAXIS3 and end of observation are known at close only
+            Cards = get_DataCards((0,) + shape, bit_pix) + [("EXTEND", True, "file contains extensions")] + get_Cards(img)
+            self._PatchCards = {c[0]: idx for idx, c in enumerate(Cards) if c[0] in ("NAXIS3", "DATE-END")}
+        else:
+            Cards = get_DataCards((), 8) + [
+                ("EXTEND", True, "file contains extensions"),
+                ("INSTRUME", img.metadata["CameraModel"], "CCD Name"),
+                ("DATE-OBS", _get_DateObs(img.metadata).isoformat(timespec="milliseconds"), "UTC time of observation start"),
+            ]
+        write_Buffers(self._fd, [format_Header(Cards)])
+
+    def append(self, img):
+        """append frame
+
+        Args:
+            img: pifcap_image.Image
+
+        Returns:
+            number of bytes written
+        """
+        if self._closed:
+            raise ValueError(f'FITS file {self.filename} is already closed')
+        Data, bit_pix = self._Writer.encode_Data(img)
+        if self._fd is None:
+            self._open(img, Data.shape, bit_pix)
+        elif self._Geometry != (Data.shape, bit_pix):
+            raise ValueError(f'frame geometry {Data.shape} does not match {self.filename}')
+        if self.Container == "cube":
+            nBytes = write_Buffers(self._fd, [Data.data])
+            self._DataBytes += nBytes
+            self._LastCards = [c for c in get_Cards(img) if c[0] == "DATE-END"]
+        else:
+            Header = self._Writer._get_Header(img, Data.shape, bit_pix, Extension=True)
+            nBytes = write_Buffers(self._fd, [Header, Data.data, bytes(_pad(Data.nbytes))])
+        DateObs = _get_DateObs(img.metadata)
+        self._Timestamps.append((
+            len(self._Timestamps),
+            DateObs.isoformat(timespec="milliseconds").encode("ascii"),
+            DateObs.timestamp(),
+            img.metadata["ExposureTime"] / 1e6,
+        ))
+        return nBytes
+
+    def _encode_Timestamps(self):
+        """return header and data of timestamp table extension"""
+        Table = np.array(self._Timestamps, dtype=[(c[0], c[1]) for c in self.TimestampColumns])
+        Cards = [
+            ("XTENSION", "BINTABLE", "binary table extension"),
+            ("BITPIX", 8, "array data type"),
+            ("NAXIS", 2, "number of array dimensions"),
+            ("NAXIS1", Table.dtype.itemsize, "bytes per row"),
+            ("NAXIS2", len(Table), "number of rows"),
+            ("PCOUNT", 0, "number of parameter bytes"),
+            ("GCOUNT", 1, "number of groups"),
+            ("TFIELDS", len(self.TimestampColumns), "number of columns"),
+        ]
+        for i, (name, dtype, form, unit) in enumerate(self.TimestampColumns):
+            Cards.append((f'TTYPE{i + 1}', name, ""))
+            Cards.append((f'TFORM{i + 1}', form, ""))
+            if unit:
+                Cards.append((f'TUNIT{i + 1}', unit, ""))
+        Cards.append(("EXTNAME", "TIMESTAMPS", "UTC start and exposure time of frames"))
+        Data = Table.tobytes()
+        return [format_Header(Cards), Data, bytes(_pad(len(Data)))]
+
+    def close(self):
+        """write timestamp table, patch primary header and close file
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._fd is None:
+            # no frame recorded
+            return
+        try:
+            if self.Container == "cube":
+                write_Buffers(self._fd, [bytes(_pad(self._DataBytes))])
+                # primary header starts at file offset 0
+                for key, value, comment in [("NAXIS3", len(self), "")] + self._LastCards:
+                    idx = self._PatchCards.get(key, None)
+                    if idx is not None:
+                        os.pwrite(self._fd, format_Card(key, value, comment), idx * CARD_SIZE)
+            write_Buffers(self._fd, self._encode_Timestamps())
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def verify_FITS(img, filename, HDU=0, Frame=None):
+    """check FITS file with astropy against the pifcap image
+
+    Args:
+        img: pifcap_image.Image
+        filename: FITS file
+        HDU: index of HDU holding the image
+        Frame: index of image in a cube, None for 2-dim data
+
+    Raises:
+        ValueError: when file content does not match
+    """
+    from astropy.io import fits
+    BayerPattern, bit_depth = pifcap_image.parse_Format(img.format)
+    array = img.array.view(np.uint16 if bit_depth > 8 else np.uint8)
+    expected = array.astype(np.int64) << ((16 if bit_depth > 8 else 8) - bit_depth)
+    with fits.open(filename) as hdul:
+        data = hdul[HDU].data if Frame is None else hdul[HDU].section[Frame]
+        if not np.array_equal(np.asarray(data).astype(np.int64), expected):
+            raise ValueError(f'{filename}: pixel data differ')
+        for key, value, comment in get_Cards(img):
+            if key in ("BZERO", "BSCALE", "COMMENT", "HISTORY"):
+                continue
+            if (Frame is not None) and (key in DynamicKeys):
+                # cube header describes the first frame
+                continue
+            if isinstance(value, str):
+                # long strings are shortened in the header
+                value = fit_String(value)
+            if hdul[HDU].header[key] != value:
+                raise ValueError(f'{filename}: {key} is {hdul[HDU].header[key]} instead of {value}')
+
+
+if __name__ == "__main__":
+    # benchmark: native writer against astropy
+    import sys
+    import time
+    import tempfile
+    from pifcap import pifcap_image
+    rng = np.random.default_rng(0)
+    nFiles = 10
+    Width, Height = 4056, 3040
+    Img = pifcap_image.Image(
+        array=rng.integers(0, 2 ** 12, size=(Height, Width), dtype=np.uint16).view(np.uint8),
+        format="SRGGB12",
+        comment="benchmark",
+        metadata={
+            "CameraModel": "imx477", "ExposureTime": 10000, "DateEnd": datetime.datetime.now(datetime.timezone.utc),
+            "UnitCellSize": (1550, 1550), "Binning": (1, 1), "FrameType": "Light", "AnalogueGain": 1.0,
+            "SensorBlackLevels": (4096, 4096, 4096, 4096),
+        },
+    )
+    from pifcap import pifcap2fits
+    Writers = {"native": FITSWriter().write}
+    if pifcap2fits.fits is not None:
+        Writers["astropy"] = pifcap2fits.write_FITS_astropy
+    else:
+        print("astropy not installed, benchmarking native writer only")
+    with tempfile.TemporaryDirectory() as Folder:
+        for name, write in Writers.items():
+            t0 = time.perf_counter()
+            for i in range(nFiles):
+                write(Img, os.path.join(Folder, f'{name}-{i}.fits'))
+            dt = time.perf_counter() - t0
+            MB = sum(os.path.getsize(os.path.join(Folder, f'{name}-{i}.fits')) for i in range(nFiles)) / 1e6
+            print(f'{name:8s}: {nFiles / dt:6.1f} files/s, {MB / dt:7.1f} MB/s')
+        if "astropy" in Writers:
+            verify_FITS(Img, os.path.join(Folder, "native-0.fits"))
+            print("native FITS file verified with astropy")
+    sys.exit(0)
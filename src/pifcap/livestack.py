@@ -0,0 +1,110 @@
+"""
+live stacking of preview images
+
+Frames are summed into a float32 accumulator which is allocated once per image shape and updated in
+place. Optionally each frame gets registered to the first frame of the stack with FFT phase correlation
+on a decimated copy.
+"""
+
+import numpy as np
+
+settings = {'name': 'live stack', 'type': 'group', 'children': [
+    {
+        'name': 'registration decimation', 'type': 'int', 'value': 4, 'limits': [1, 16],
+        'tip': 'use only every n-th pixel of the preview image to find the shift between frames',
+    },
+]}
+
+
+def phase_correlation(ref_fft, img_fft, shape):
+    """return shift (dy, dx) of image against reference from their 2-dim real FFTs
+
+    Args:
+        ref_fft: np.fft.rfft2 of reference
+        img_fft: np.fft.rfft2 of image
+        shape: shape of the transformed arrays (needed for odd widths)
+
+    Returns:
+        (dy, dx) in pixels of the transformed arrays
+    """
+    R = ref_fft * np.conj(img_fft)
+    R /= np.abs(R) + 1e-12
+    r = np.fft.irfft2(R, s=shape)
+    dy, dx = np.unravel_index(np.argmax(r), r.shape)
+    # wrap around to signed shifts
+    if dy > r.shape[0] // 2:
+        dy -= r.shape[0]
+    if dx > r.shape[1] // 2:
+        dx -= r.shape[1]
+    return int(dy), int(dx)
+
+
+class LiveStack:
+    """running average of preview images
+    """
+
+    def __init__(self, Decimation=4):
+        self.Decimation = Decimation
+        self.Accumulator = None
+        self.Count = None
+        self.Mean = None
+        self.nFrames = 0
+        self._Key = None
+        self._RefFFT = None
+        # shape of the decimated images of the FFTs
+        self._FFTShape = None
+
+    def reset(self):
+        """start a new stack with the next frame
+        """
+        self.nFrames = 0
+        self._RefFFT = None
+        if self.Accumulator is not None:
+            self.Accumulator.fill(0)
+            self.Count.fill(0)
+
+    def _get_FFT(self, img):
+        """FFT of decimated image with mean removed"""
+        d = img[::self.Decimation, ::self.Decimation].astype(np.float32)
+        d -= d.mean()
+        self._FFTShape = d.shape
+        return np.fft.rfft2(d)
+
+    def add(self, img, Key=None, Register=False):
+        """add image to stack
+
+        Args:
+            img: 2-dim image
+            Key: stack gets reset when this changes (for instance raw mode and exposure settings)
+            Register: shift image to match the first image of the stack
+
+        Returns:
+            average of stacked images (float32 array, overwritten by next call)
+        """
+        if (self.Accumulator is None) or (self.Accumulator.shape != img.shape):
+            # allocate buffers once per image shape
+            self.Accumulator = np.zeros(img.shape, dtype=np.float32)
+            self.Count = np.zeros(img.shape, dtype=np.float32)
+            self.Mean = np.zeros(img.shape, dtype=np.float32)
+            self.reset()
+        if Key != self._Key:
+            self._Key = Key
+            self.reset()
+        dy, dx = 0, 0
+        if Register:
+            img_fft = self._get_FFT(img)
+            if self._RefFFT is None:
+                self._RefFFT = img_fft
+            else:
+                dy, dx = phase_correlation(self._RefFFT, img_fft, self._FFTShape)
+                dy *= self.Decimation
+                dx *= self.Decimation
+        # overlapping region of shifted image and accumulator
+        h, w = img.shape
+        dst = (slice(max(dy, 0), h + min(dy, 0)), slice(max(dx, 0), w + min(dx, 0)))
+        src = (slice(max(-dy, 0), h + min(-dy, 0)), slice(max(-dx, 0), w + min(-dx, 0)))
+        np.add(self.Accumulator[dst], img[src], out=self.Accumulator[dst], casting="unsafe")
+        self.Count[dst] += 1
+        self.nFrames += 1
+        np.divide(self.Accumulator, self.Count, out=self.Mean, where=self.Count > 0)
+        return self.Mean
@@ -5,6 +5,9 @@ Fast Raspberry Pi image capturing software for Lucky Imaging.
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
 import os
+import time
+import resource
+import tracemalloc
 import os.path
 import numpy as np
 import pyqtgraph as pg
@@ -13,6 +16,10 @@ from . import pifcap_ui
 from . import camera
 from . import settings
 from . import autoexposure
+from . import writer
+from . import timing
+from . import quality
+from . import livestack
 
 __author__ = "Ronald Schreiber"
 __copyright__ = "Copyright 2024"
@@ -40,6 +47,10 @@ class MainWin(QtWidgets.QMainWindow):
             },
             autoexposure.settings,
             camera.settings,
+            writer.settings,
+            timing.settings,
+            quality.settings,
+            livestack.settings,
             {'name': 'recording', 'type': 'group', 'children': [
                 {
                     'name': 'default folder', 'type': 'str', 'value': os.path.join(os.path.expanduser("~"), "Pictures"),
@@ -68,6 +79,16 @@ class MainWin(QtWidgets.QMainWindow):
         self.SaturatedPixelImage = pg.ImageItem()
         self.SaturatedPixelImage.setZValue(65000)
         self.ui.ImageView_Preview.addItem(self.SaturatedPixelImage)
+        # region of interest for recording (in preview image coordinates)
+        self.RecordingROI = pg.RectROI([0, 0], [200, 200], pen=pg.mkPen("g", width=2))
+        self.RecordingROI.setZValue(65001)
+        self.ui.ImageView_Preview.addItem(self.RecordingROI)
+        self.RecordingROI.hide()
+        # region for exposure metering (in preview image coordinates)
+        self.MeteringROI = pg.RectROI([0, 0], [200, 200], pen=pg.mkPen("y", width=2))
+        self.MeteringROI.setZValue(65002)
+        self.ui.ImageView_Preview.addItem(self.MeteringROI)
+        self.MeteringROI.hide()
         #
         self.ImageFolder = self.Settings.get('recording', 'default folder')
         # camera
@@ -84,8 +105,19 @@ class MainWin(QtWidgets.QMainWindow):
         self.ui.comboBox_FrameType.currentIndexChanged.connect(self.on_RecordingSettingsChanged)
         # preview image
         self.Img = None
+        # smoothed CPU time of preview processing
+        self.PreviewTime = None
+        # reused preview buffers and number of buffer allocations
+        self.PreviewBuffers = dict()
+        self.PreviewAllocations = 0
+        # number of frame writer errors already reported
+        self.WriterErrors = 0
+        # number of frame scoring errors already reported
+        self.SelectorErrors = 0
         # exposure time optimization
         self.AutoExposure = autoexposure.AutoExposure(Settings=self.Settings)
+        # live stacking of preview images
+        self.LiveStack = livestack.LiveStack()
 
     def add_LogMessage(self, Msg, Severity="INFO"):
         if Severity=="ERROR":
@@ -157,6 +189,7 @@ class MainWin(QtWidgets.QMainWindow):
             self.ui.doubleSpinBox_ExposureTime.setMaximum(self.Cam.CameraSettings.MaxExposureTime)
             self.ui.doubleSpinBox_ExposureTime.setMinimum(self.Cam.CameraSettings.MinExposureTime)
             self.ui.doubleSpinBox_ExposureTime.setValue(self.Cam.CameraSettings.ExposureTime)
+            self.ui.spinBox_BufferCount.setValue(self.Cam.CameraSettings.BufferCount)
 
 
     @QtCore.pyqtSlot(float)
@@ -167,6 +200,11 @@ class MainWin(QtWidgets.QMainWindow):
     def on_doubleSpinBox_Gain_valueChanged(self, g):
         self.Cam.CameraSettings.Gain = g
 
+    @QtCore.pyqtSlot(int)
+    def on_spinBox_BufferCount_valueChanged(self, n):
+        if self.Cam.is_Open():
+            self.Cam.CameraSettings.BufferCount = n
+
     @QtCore.pyqtSlot()
     def on_pushButton_Folder_clicked(self):
         ImageFolder = QtWidgets.QFileDialog.getExistingDirectory(
@@ -187,6 +225,32 @@ class MainWin(QtWidgets.QMainWindow):
             FrameType=self.ui.comboBox_FrameType.currentText(),
         )
 
+    @QtCore.pyqtSlot(int)
+    def on_checkBox_ROI_stateChanged(self, state):
+        if state:
+            self.RecordingROI.show()
+        else:
+            self.RecordingROI.hide()
+            self.Cam.CameraSettings.ROI = None
+
+    @QtCore.pyqtSlot(int)
+    def on_checkBox_LiveStack_stateChanged(self, state):
+        self.LiveStack.reset()
+        self.ui.checkBox_LiveStack.setText("live stack")
+
+    @QtCore.pyqtSlot(int)
+    def on_checkBox_StackRegister_stateChanged(self, state):
+        self.LiveStack.reset()
+
+    @QtCore.pyqtSlot(int)
+    def on_comboBox_Metering_currentIndexChanged(self, idx):
+        if self.ui.comboBox_Metering.currentText() == "full frame":
+            self.MeteringROI.hide()
+        else:
+            self.MeteringROI.show()
+        # the automatic metering region follows the brightest blob
+        self.MeteringROI.translatable = self.ui.comboBox_Metering.currentText() == "manual ROI"
+
     @QtCore.pyqtSlot(int)
     def on_checkBox_OptimizeExposure_stateChanged(self, state):
         if state:
@@ -198,10 +262,35 @@ class MainWin(QtWidgets.QMainWindow):
             f'{Img["RecordingInfos"]["disc_free"]/1024/1024:.0f} MiB (~{Img["RecordingInfos"]["disc_free_images"]} images) free'
         )
         self.ui.label_RecordedImageCounter.setText(f'{Img["RecordingInfos"]["ImagesRecorded"]} images saved')
+        self.ui.label_DroppedFrames.setText(f'{Img["metadata"]["DroppedFrames"]} frames dropped')
+        WriterStats = Img["RecordingInfos"]["WriterStats"]
+        self.ui.label_WriterInfos.setText(
+            f'queue: {WriterStats["depth"]} (peak {WriterStats["peak_depth"]}), '
+            f'{WriterStats["blocked"]} blocked, {WriterStats["dropped"]} dropped'
+        )
+        SelectorStats = Img["RecordingInfos"]["SelectorStats"]
+        if SelectorStats is not None:
+            self.ui.label_WriterInfos.setText(
+                self.ui.label_WriterInfos.text() +
+                f'; {SelectorStats["kept"]} kept, {SelectorStats["rejected"]} rejected, '
+                f'scoring: {SelectorStats["blocked"]} blocked, {SelectorStats["dropped"]} dropped' +
+                ('' if SelectorStats["last_score"] is None else f', sharpness {SelectorStats["last_score"]:.3g}')
+            )
+            if SelectorStats["errors"] > self.SelectorErrors:
+                self.log_Warn(
+                    f'{SelectorStats["errors"]} frames recorded without score, last error: {SelectorStats["last_error"]}'
+                )
+            self.SelectorErrors = SelectorStats["errors"]
+        if WriterStats["errors"] > self.WriterErrors:
+            self.log_Error(f'{WriterStats["errors"]} frames not written, last error: {WriterStats["last_error"]}')
+        self.WriterErrors = WriterStats["errors"]
         self.log_Debug(f'received image: {Img["format"]}, {Img["array"].shape}, {Img["array"].dtype}')
         self.log_Debug(f'received metadata: {Img["metadata"]}')
         self.Img = Img
         self.process_Image()
+        if self.Cam.Timing is not None:
+            self.Cam.Timing.mark(Img["metadata"]["FrameNumber"], "preview")
+            self.log_Debug(f'pipeline timing: {self.Cam.Timing.summary()}')
         # TODO: wie wird Aufnahme automatisch gestoppt?
         QtCore.QTimer.singleShot(100, self.request_NewImage)
 
@@ -209,6 +298,11 @@ class MainWin(QtWidgets.QMainWindow):
         self.Cam.Sig_GiveImage.set()
 
     def process_Image(self):
+        t_start = time.thread_time()
+        # with --debug: memory allocated while processing the preview (all threads)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            TracedStart = tracemalloc.get_traced_memory()[0]
         format = self.Img["format"]
         array = self.Img["array"]
         # we expect uncompressed format here
@@ -226,86 +320,308 @@ class MainWin(QtWidgets.QMainWindow):
             # mono format
             BayerPattern = None
             bit_depth = int(format[1:])
-        # left adjust if needed
         if bit_depth > 8:
             bit_pix = 16
-            array = array.view(np.uint16) * (2 ** (bit_pix - bit_depth))
+            array = array.view(np.uint16)
         else:
             bit_pix = 8
-            array = array.view(np.uint8) * (2 ** (bit_pix - bit_depth))
+            array = array.view(np.uint8)
+        # left adjust preview images by this shift
+        shift = bit_pix - bit_depth
         #
         # remove 0- or garbage-filled columns # TODO implement this?
         #true_size = self.present_CameraSettings.RawMode["true_size"]
         #array = array[0:true_size[1], 0:true_size[0]]
-        # exposure time optimization
-        if self.ui.checkBox_OptimizeExposure.isChecked():
-            finished, newExposureTime = self.AutoExposure.do_optimize(
-                array=array,
-                ExposureTime=self.Img["metadata"]["ExposureTime"]/1e6,
-                n_bits=bit_pix,
-                MinExposureTime=self.ui.doubleSpinBox_ExposureTime.minimum(),
-                MaxExposureTime=self.ui.doubleSpinBox_ExposureTime.maximum()
-            )
-            if finished:
-                self.ui.checkBox_OptimizeExposure.setChecked(False)
-            else:
-                self.ui.doubleSpinBox_ExposureTime.setValue(newExposureTime)
-        # color channels
-        imgR = None
-        imgG1 = None
-        imgG2 = None
-        imgB = None
+        # color channels (views of raw array)
         if BayerPattern is None:
             # mono format
-            img = array
+            Planes = {"mono": array}
         else:
             BayerChannels = {
                 "GBRG": {"G1": (0, 0), "B": (0, 1), "R": (1, 0), "G2": (1, 1)},
                 "BGGR": {"B": (0, 0), "G1": (0, 1), "G2": (1, 0), "R": (1, 1)},
             }[BayerPattern]
-            imgR = array[BayerChannels["R"][0]::2, BayerChannels["R"][1]::2]
-            imgG1 = array[BayerChannels["G1"][0]::2, BayerChannels["G1"][1]::2]
-            imgG2 = array[BayerChannels["G2"][0]::2, BayerChannels["G2"][1]::2]
-            imgB = array[BayerChannels["B"][0]::2, BayerChannels["B"][1]::2]
+            Planes = {
+                name: array[BayerChannels[name][0]::2, BayerChannels[name][1]::2] for name in ["R", "G1", "G2", "B"]
+            }
+        # preview rotation and flip (views only, no copies)
+        Rot = self.ui.comboBox_PreviewRot.currentText()
+        FlipH = self.ui.checkBox_PreviewFlipH.isChecked()
+        FlipV = self.ui.checkBox_PreviewFlipV.isChecked()
+        PlaneShape = Planes["mono" if BayerPattern is None else "R"].shape
+        Planes = {name: self.flipRotate_Image(p, Rot, FlipH, FlipV) for name, p in Planes.items()}
+        # decimate planes to display resolution, keep full resolution only for zoomed region
+        H, W = (PlaneShape[1], PlaneShape[0]) if Rot in ["90deg", "270deg"] else PlaneShape
+        i0, i1, j0, j1, D = self.get_PreviewRegion(H, W)
+        Planes = {name: p[i0:i1:D, j0:j1:D] for name, p in Planes.items()}
+        if BayerPattern is None:
+            Plane = Planes["mono"]
+        else:
             RawPreviewMode = self.ui.comboBox_RawPreviewMode.currentText()
             if RawPreviewMode == "luminance":
-                img = (0.2126 * imgR + 0.7152 / 2 * imgG1 + 0.7152 / 2 * imgG2 + 0.0722 * imgB).astype(int)
+                Plane = None
             elif RawPreviewMode == "red":
-                img = imgR
+                Plane = Planes["R"]
             elif RawPreviewMode == "green 1":
-                img = imgG1
+                Plane = Planes["G1"]
             elif RawPreviewMode == "green 2":
-                img = imgG2
+                Plane = Planes["G2"]
             elif RawPreviewMode == "blue":
-                img = imgB
+                Plane = Planes["B"]
             else:
                 raise NotImplementedError
-        # preview rotation and flip
-        Rot = self.ui.comboBox_PreviewRot.currentText()
-        FlipH = self.ui.checkBox_PreviewFlipH.isChecked()
-        FlipV = self.ui.checkBox_PreviewFlipV.isChecked()
-        img = self.flipRotate_Image(img, Rot, FlipH, FlipV)
-        # show preview image
+        if Plane is None:
+            # luminance with integer weights 0.2126, 0.7152 / 2, 0.7152 / 2, 0.0722 scaled by 256
+            img = self.get_PreviewBuffer("luminance", Planes["R"].shape, np.uint32)
+            tmp = self.get_PreviewBuffer("product", Planes["R"].shape, np.uint32)
+            np.multiply(Planes["R"], 54, out=img, dtype=np.uint32)
+            for name, weight in [("G1", 92), ("G2", 92), ("B", 18)]:
+                np.multiply(Planes[name], weight, out=tmp, dtype=np.uint32)
+                np.add(img, tmp, out=img)
+            np.right_shift(img, 8 - shift, out=img)
+        else:
+            img = self.get_PreviewBuffer("channel", Plane.shape, Plane.dtype)
+            np.left_shift(Plane, shift, out=img)
+        # metering region for exposure optimization and saturation statistics
+        PixelsPerPlanePixel = 1 if BayerPattern is None else 2
+        MeteringROI = self.get_MeteringROI(
+            img, array.shape, (i0, j0, D), PlaneShape, Rot, FlipH, FlipV, PixelsPerPlanePixel
+        )
+        if MeteringROI is None:
+            MeterArray = array
+        else:
+            x, y, w, h = MeteringROI
+            MeterArray = array[y:y + h, x:x + w]
+        stride = autoexposure.get_SubsamplingStride(self.Settings)
+        MeterSamples = MeterArray[::stride, ::stride]
+        is_MeterSat = self.get_PreviewBuffer("metering saturated", MeterSamples.shape, bool)
+        np.greater_equal(MeterSamples, 2 ** bit_depth - 1, out=is_MeterSat)
+        SaturatedFraction = np.count_nonzero(is_MeterSat) / max(is_MeterSat.size, 1)
+        # exposure time optimization
+        if self.ui.checkBox_OptimizeExposure.isChecked():
+            # black levels are reported in 16 bit scale
+            BlackLevels = self.Img["metadata"]["SensorBlackLevels"]
+            BlackLevel = 0 if BlackLevels is None else np.mean(BlackLevels) / 2 ** (16 - bit_depth)
+            finished, newExposureTime, newGain = self.AutoExposure.do_optimize(
+                array=MeterArray,
+                ExposureTime=self.Img["metadata"]["ExposureTime"]/1e6,
+                Gain=self.Img["metadata"]["AnalogueGain"],
+                n_bits=bit_depth,
+                BlackLevel=BlackLevel,
+                MinExposureTime=self.ui.doubleSpinBox_ExposureTime.minimum(),
+                MaxExposureTime=self.ui.doubleSpinBox_ExposureTime.maximum(),
+                MinGain=self.ui.doubleSpinBox_Gain.minimum(),
+                MaxGain=self.ui.doubleSpinBox_Gain.maximum(),
+            )
+            if finished:
+                self.ui.checkBox_OptimizeExposure.setChecked(False)
+                self.log_Info(
+                    f'automatic exposure {"converged" if self.AutoExposure.converged else "stopped"} '
+                    f'after {self.AutoExposure.iteration} frames: '
+                    f'{newExposureTime:.6f}s, gain {newGain:.2f}'
+                )
+            else:
+                self.ui.doubleSpinBox_ExposureTime.setValue(newExposureTime)
+                self.ui.doubleSpinBox_Gain.setValue(newGain)
+        # live stacking
+        if self.ui.checkBox_LiveStack.isChecked():
+            self.LiveStack.Decimation = self.Settings.get('live stack', 'registration decimation')
+            img = self.LiveStack.add(
+                img,
+                Key=(
+                    self.ui.comboBox_RawMode.currentIndex(), self.ui.comboBox_RawPreviewMode.currentText(),
+                    self.Cam.CameraSettings.ExposureTime, self.Cam.CameraSettings.Gain,
+                    self.LiveStack.Decimation, Rot, FlipH, FlipV, (i0, i1, j0, j1, D),
+                ),
+                Register=self.ui.checkBox_StackRegister.isChecked(),
+            )
+            self.ui.checkBox_LiveStack.setText(f'live stack ({self.LiveStack.nFrames})')
+        # region of interest for recording
+        if self.ui.checkBox_ROI.isChecked():
+            self.Cam.CameraSettings.ROI = self.get_SensorROI(
+                self.RecordingROI, PlaneShape, Rot, FlipH, FlipV, PixelsPerPlanePixel
+            )
+        # show preview image, placed in full resolution coordinates
         self.ui.ImageView_Preview.setImage(img, autoLevels=False,
                                             autoHistogramRange=False,
                                             #levelMode="rgb",
                                             autoRange=False,
+                                            pos=(j0, i0), scale=(D, D),
                                             )
         # highlight saturated pixel
         if self.ui.checkBox_Saturation.isChecked():
-            sat = np.zeros((img.shape[0], img.shape[1], 4), dtype=int)
-            sat[:, :, 0] = 1  # pure red, full transparent
-            satLim = (2**bit_pix) * self.Settings.get('saturation limit') / 100
+            satLim = (2**bit_depth) * self.Settings.get('saturation limit') / 100
             if BayerPattern is None:
-                # mono image
-                is_sat = img > satLim
+                PlaneMax = Planes["mono"]
             else:
-                is_sat = (imgR > satLim) | (imgG1 > satLim) | (imgG2 > satLim) | (imgB > satLim)
-            is_sat = self.flipRotate_Image(is_sat, Rot, FlipH, FlipV)
-            sat[:, :, 3] = is_sat * 1  # saturated pixel get intransparent red
-            self.SaturatedPixelImage.setImage(sat, levels=[[0, 1], [0, 1], [0, 1], [0, 1]])
+                # one comparison against maximum of all Bayer planes
+                PlaneMax = self.get_PreviewBuffer("max", Planes["R"].shape, Planes["R"].dtype)
+                np.maximum(Planes["R"], Planes["G1"], out=PlaneMax)
+                np.maximum(PlaneMax, Planes["G2"], out=PlaneMax)
+                np.maximum(PlaneMax, Planes["B"], out=PlaneMax)
+            is_sat = self.get_PreviewBuffer("saturated", PlaneMax.shape, bool)
+            np.greater(PlaneMax, satLim, out=is_sat)
+            sat = self.get_PreviewBuffer("overlay", PlaneMax.shape + (4,), np.uint8)
+            # saturated pixel get intransparent red
+            np.multiply(is_sat, 255, out=sat[:, :, 3], dtype=np.uint8)
+            self.SaturatedPixelImage.setImage(sat, levels=[[0, 255], [0, 255], [0, 255], [0, 255]])
+            self.SaturatedPixelImage.setRect(QtCore.QRectF(j0, i0, img.shape[1] * D, img.shape[0] * D))
         else:
             self.SaturatedPixelImage.clear()
+        # CPU time of preview
+        t = time.thread_time() - t_start
+        self.PreviewTime = t if self.PreviewTime is None else 0.9 * self.PreviewTime + 0.1 * t
+        Infos = (
+            f'preview: {self.PreviewTime * 1e3:.1f} ms CPU, {img.shape[1]}x{img.shape[0]} (1:{D}), '
+            f'{100 * SaturatedFraction:.2f}% saturated, '
+            f'{self.PreviewAllocations} buffer allocations, '
+            f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB'
+        )
+        if tracemalloc.is_tracing():
+            Infos += f', {(tracemalloc.get_traced_memory()[1] - TracedStart) / 2 ** 20:.1f} MiB allocated'
+        self.ui.label_PreviewInfos.setText(Infos)
+
+    def get_PreviewBuffer(self, name, shape, dtype):
+        """return preallocated preview buffer, reallocated only when shape or data type change
+
+        Args:
+            name: buffer name
+            shape: shape of buffer
+            dtype: data type of buffer
+
+        Returns:
+            array with undefined content (overlay buffers are initialized to transparent red)
+        """
+        buf = self.PreviewBuffers.get(name, None)
+        if (buf is None) or (buf.shape != shape) or (buf.dtype != np.dtype(dtype)):
+            buf = np.empty(shape, dtype=dtype)
+            self.PreviewAllocations += 1
+            if name == "overlay":
+                # pure red, full transparent
+                buf[...] = (255, 0, 0, 0)
+            self.PreviewBuffers[name] = buf
+        return buf
+
+    def get_PreviewRegion(self, H, W):
+        """return visible region and decimation of rotated and flipped preview image
+
+        Args:
+            H, W: full resolution height and width of rotated and flipped preview image
+
+        Returns:
+            (i0, i1, j0, j1, D): rows i0:i1 and columns j0:j1 get shown with every D-th pixel
+        """
+        View = self.ui.ImageView_Preview.getView()
+        if all(View.autoRangeEnabled()):
+            # complete image visible
+            i0, i1, j0, j1 = 0, H, 0, W
+            ScreenH, ScreenW = View.height(), View.width()
+            D = int(max(H / ScreenH, W / ScreenW)) if (ScreenH > 0) and (ScreenW > 0) else 1
+        else:
+            # zoomed
+            (x0, x1), (y0, y1) = View.viewRange()
+            px, py = View.viewPixelSize()
+            D = int(min(px, py))
+            j0 = min(max(int(np.floor(x0)), 0), W - 1)
+            j1 = min(max(int(np.ceil(x1)), j0 + 1), W)
+            i0 = min(max(int(np.floor(y0)), 0), H - 1)
+            i1 = min(max(int(np.ceil(y1)), i0 + 1), H)
+        D = max(1, min(D, i1 - i0, j1 - j0))
+        # region size multiple of decimation to keep decimated pixels aligned when placed in view
+        i1 = i0 + ((i1 - i0) // D) * D
+        j1 = j0 + ((j1 - j0) // D) * D
+        return i0, i1, j0, j1, D
+
+    def get_MeteringROI(self, img, SensorShape, Region, PlaneShape, Rot, FlipH, FlipV, PixelsPerPlanePixel):
+        """return metering region (x, y, width, height) in sensor pixels or None for full frame
+
+        Args:
+            img: decimated preview image
+            SensorShape: shape of raw array
+            Region: (i0, j0, D) origin and decimation of preview image
+            PlaneShape: shape of preview image before rotation and flip
+            Rot, FlipH, FlipV: preview rotation and flip
+            PixelsPerPlanePixel: 2 for Bayer planes, 1 for mono; keeps ROI aligned to the Bayer pattern
+        """
+        Metering = self.ui.comboBox_Metering.currentText()
+        if Metering == "manual ROI":
+            return self.get_SensorROI(self.MeteringROI, PlaneShape, Rot, FlipH, FlipV, PixelsPerPlanePixel)
+        elif Metering != "brightest blob":
+            return None
+        # brightest block of preview image
+        i0, j0, D = Region
+        Block = 4
+        h, w = (img.shape[0] // Block) * Block, (img.shape[1] // Block) * Block
+        if (h == 0) or (w == 0):
+            return None
+        Binned = img[:h, :w].reshape(h // Block, Block, w // Block, Block).sum(axis=(1, 3))
+        bi, bj = np.unravel_index(np.argmax(Binned), Binned.shape)
+        # center in full resolution preview and in sensor pixels
+        ci = i0 + (bi * Block + Block // 2) * D
+        cj = j0 + (bj * Block + Block // 2) * D
+        a, b = self.unflipRotate_Point(ci, cj, PlaneShape, Rot, FlipH, FlipV)
+        Size = self.Settings.get('automatic exposure', 'metering ROI size')
+        Size = min(Size, SensorShape[0], SensorShape[1]) // 2 * 2
+        x = min(max(b * PixelsPerPlanePixel - Size // 2, 0), SensorShape[1] - Size) // 2 * 2
+        y = min(max(a * PixelsPerPlanePixel - Size // 2, 0), SensorShape[0] - Size) // 2 * 2
+        # show metering region
+        PreviewSize = Size / PixelsPerPlanePixel
+        self.MeteringROI.setPos((cj - PreviewSize / 2, ci - PreviewSize / 2))
+        self.MeteringROI.setSize((PreviewSize, PreviewSize))
+        return x, y, Size, Size
+
+    def unflipRotate_Point(self, i, j, PlaneShape, Rot, FlipH, FlipV):
+        """map pixel (row i, column j) of rotated and flipped preview back to preview plane
+
+        This is the inverse of flipRotate_Image.
+        """
+        h, w = PlaneShape
+        k = {"0deg": 0, "90deg": 3, "180deg": 2, "270deg": 1}[Rot]
+        # shape after rotation
+        H, W = (w, h) if k % 2 else (h, w)
+        if FlipV:
+            i = H - 1 - i
+        if FlipH:
+            j = W - 1 - j
+        if k == 1:
+            i, j = j, w - 1 - i
+        elif k == 2:
+            i, j = h - 1 - i, w - 1 - j
+        elif k == 3:
+            i, j = h - 1 - j, i
+        return i, j
+
+    def get_SensorROI(self, ROI, PlaneShape, Rot, FlipH, FlipV, PixelsPerPlanePixel):
+        """return ROI (x, y, width, height) in sensor pixels
+
+        Args:
+            ROI: pg.RectROI in preview
+            PlaneShape: shape of preview image before rotation and flip
+            Rot, FlipH, FlipV: preview rotation and flip
+            PixelsPerPlanePixel: 2 for Bayer planes, 1 for mono; keeps ROI aligned to the Bayer pattern
+
+        Returns:
+            ROI or None when ROI is outside of image
+        """
+        h, w = PlaneShape
+        # ROI in rotated and flipped preview
+        H, W = (w, h) if Rot in ["90deg", "270deg"] else (h, w)
+        pos = ROI.pos()
+        size = ROI.size()
+        j0 = min(max(int(round(pos.x())), 0), W - 1)
+        i0 = min(max(int(round(pos.y())), 0), H - 1)
+        j1 = min(max(int(round(pos.x() + size.x())) - 1, 0), W - 1)
+        i1 = min(max(int(round(pos.y() + size.y())) - 1, 0), H - 1)
+        if (j1 < j0) or (i1 < i0):
+            return None
+        # corners in preview plane
+        a0, b0 = self.unflipRotate_Point(i0, j0, PlaneShape, Rot, FlipH, FlipV)
+        a1, b1 = self.unflipRotate_Point(i1, j1, PlaneShape, Rot, FlipH, FlipV)
+        x = min(b0, b1) * PixelsPerPlanePixel
+        y = min(a0, a1) * PixelsPerPlanePixel
+        width = (abs(b1 - b0) + 1) * PixelsPerPlanePixel
+        height = (abs(a1 - a0) + 1) * PixelsPerPlanePixel
+        return x, y, width, height
 
     def flipRotate_Image(self, img, Rot, FlipH, FlipV):
         if Rot != "0deg":
@@ -326,6 +642,8 @@ class MainWin(QtWidgets.QMainWindow):
     @QtCore.pyqtSlot()
     def on_pushButton_StopRec_clicked(self):
         self.Cam.Recording(False)
+        if self.Cam.Timing is not None:
+            self.log_Info(f'pipeline timing: {self.Cam.Timing.summary()}')
         self.ui.pushButton_StartRec.setEnabled(True)
         self.ui.pushButton_StopRec.setEnabled(False)
 
@@ -376,6 +694,9 @@ def main():
     else:
         pass
     #
+    if args.debug and hasattr(tracemalloc, "reset_peak"):
+        # report memory allocated by preview processing (Python >= 3.9)
+        tracemalloc.start()
     MainWindow = MainWin(showDebugMessages=args.debug)
     # MainWindow.resize(1400, 900)
     MainWindow.show()
@@ -1,183 +1,347 @@
 """
 command line program to convert pifcap internal image format to FITS
+
+`pifcap2fits calibrate ...` builds master calibration frames (see `calibration.main`).
 """
 
 import sys
 import os.path
-import pickle
 import glob
 import numpy as np
 import argparse
 import multiprocessing
-import time
-import datetime
-from astropy.io import fits
+import queue
+import collections
+try:
+    # optional, for verification and as alternative FITS writer
+    from astropy.io import fits
+except ImportError:
+    fits = None
 
+from . import pifcap_image
+from . import pifcap_sequence
+from . import filewatch
+from . import fitswriter
+from . import serwriter
+from . import calibration
 
-def convert(input_filename, remove, skip_existing):
-    output_filename = input_filename.rsplit(".", maxsplit=1)[0] + ".fits"
-    if not(skip_existing and os.path.isfile(output_filename)):
-        # convert
-        retrials = 20
-        while True:
-            try:
-                with open(input_filename, "rb") as fh:
-                    img = pickle.load(fh)
-            except EOFError:
-                retrials -= 1
-                if retrials > 0:
-                    time.sleep(0.1)
-                else:
-                    print(f'ERROR: Can not open {input_filename}', file=sys.stderr)
-                    return input_filename
-            else:
-                break
-        array = img["array"]
-        format = img["format"]
-        metadata = img["metadata"]
-        # we expect uncompressed format here
-        if format.count("_") > 0:
-            raise NotImplementedError(f'got unsupported raw image format {format}')
-        if format[0] not in ["S", "R"]:
-            raise NotImplementedError(f'got unsupported raw image format {format}')
-        # Bayer or mono format
-        if format[0] == "S":
-            # Bayer pattern format
-            BayerPattern = format[1:5]
-            bit_depth = int(format[5:])
-        else:
-            # mono format
-            BayerPattern = None
-            bit_depth = int(format[1:])
-        # left adjust if needed
-        if bit_depth > 8:
-            bit_pix = 16
-            array = array.view(np.uint16) * (2 ** (bit_pix - bit_depth))
+
+# FITS writer of this process, keeps header template and buffers between frames
+_FITSWriter = fitswriter.FITSWriter()
+
+
+def write_FITS(img, output_filename, backend="native", verify=False):
+    """write pifcap image to FITS file
+
+    Args:
+        img: pifcap_image.Image
+        output_filename: name of FITS file
+        backend: "native" or "astropy"
+        verify: check written file with astropy
+    """
+    if backend == "astropy":
+        write_FITS_astropy(img, output_filename)
+    else:
+        _FITSWriter.write(img, output_filename)
+    if verify:
+        fitswriter.verify_FITS(img, output_filename)
+
+
+def write_FITS_astropy(img, output_filename):
+    """write pifcap image to FITS file with astropy
+
+    Args:
+        img: pifcap_image.Image
+        output_filename: name of FITS file
+    """
+    if fits is None:
+        raise NotImplementedError("astropy is not installed")
+    BayerPattern, bit_depth = pifcap_image.parse_Format(img.format)
+    # left adjust if needed
+    if bit_depth > 8:
+        bit_pix = 16
+        array = img.array.view(np.uint16) * (2 ** (bit_pix - bit_depth))
+    else:
+        bit_pix = 8
+        array = img.array.view(np.uint8) * (2 ** (bit_pix - bit_depth))
+    # convert to FITS
+    hdu = fits.PrimaryHDU(array)
+    for key, value, comment in fitswriter.get_Cards(img):
+        if key in ("COMMENT", "HISTORY"):
+            hdu.header[key.lower()] = value
         else:
-            bit_pix = 8
-            array = array.view(np.uint8) * (2 ** (bit_pix - bit_depth))
-        # convert to FITS
-        hdu = fits.PrimaryHDU(array)
-        hdu.header["BZERO"] = (2 ** (bit_pix - 1), "offset data range")
-        hdu.header["BSCALE"] = (1, "default scaling factor")
-        hdu.header["ROWORDER"] = ("TOP-DOWN", "Row order")
-        hdu.header["INSTRUME"] = (metadata["CameraModel"], "CCD Name")
-        hdu.header["EXPTIME"] = (metadata["ExposureTime"]/1e6, "[s] Total Exposure Time")
-        hdu.header["DATE-OBS"] = (
-            (metadata["DateEnd"] - datetime.timedelta(seconds=metadata["ExposureTime"]/1e6)).isoformat(timespec="milliseconds"),
-            "UTC time of observation start"
-        )
-        hdu.header["DATE-END"] = (metadata["DateEnd"].isoformat(timespec="milliseconds"), "UTC time at end of observation")
-        #hdu.header["CCD-TEMP"] = (metadata.get('SensorTemperature', 0), "[degC] CCD Temperature")
-        hdu.header["PIXSIZE1"] = (metadata["UnitCellSize"][0] / 1e3, "[um] Pixel Size 1")
-        hdu.header["PIXSIZE2"] = (metadata["UnitCellSize"][1] / 1e3, "[um] Pixel Size 2")
-        hdu.header["XBINNING"] = (metadata["Binning"][0], "Binning factor in width")
-        hdu.header["YBINNING"] = (metadata["Binning"][1], "Binning factor in height")
-        hdu.header["XPIXSZ"] = (metadata["UnitCellSize"][0] / 1e3 * metadata["Binning"][0], "[um] X binned pixel size")
-        hdu.header["YPIXSZ"] = (metadata["UnitCellSize"][1] / 1e3 * metadata["Binning"][1], "[um] Y binned pixel size")
-        hdu.header["FRAME"] = (metadata["FrameType"], "Frame Type")
-        hdu.header["IMAGETYP"] = (metadata["FrameType"] + " Frame", "Frame Type")
-        hdu.header["GAIN"] = (metadata["AnalogueGain"], "Gain")
-        if BayerPattern is not None:
-            hdu.header["XBAYROFF"] = (0, "[px] X offset of Bayer array")
-            hdu.header["YBAYROFF"] = (0, "[px] Y offset of Bayer array")
-            hdu.header["BAYERPAT"] = (BayerPattern, "Bayer color pattern")
-        if "SensorBlackLevels" in metadata:
-            SensorBlackLevels = metadata["SensorBlackLevels"]
-            if len(SensorBlackLevels) == 4:
-                # according to picamera2 documentation:
-                #   "The black levels of the raw sensor image. This
-                #    control appears only in captured image
-                #    metadata and is read-only. One value is
-                #    reported for each of the four Bayer channels,
-                #    scaled up as if the full pixel range were 16 bits
-                #    (so 4096 represents a black level of 16 in 10-
-                #    bit raw data)."
-                # When image data is stored as 16bit it is not needed to scale SensorBlackLevels again.
-                # But when we store image with 8bit/pixel we need to divide by 2**8.
-                SensorBlackLevelScaling = 2 ** (bit_pix - 16)
-                hdu.header["OFFSET_0"] = (SensorBlackLevels[0] * SensorBlackLevelScaling, "[DN] Sensor Black Level 0")
-                hdu.header["OFFSET_1"] = (SensorBlackLevels[1] * SensorBlackLevelScaling, "[DN] Sensor Black Level 1")
-                hdu.header["OFFSET_2"] = (SensorBlackLevels[2] * SensorBlackLevelScaling, "[DN] Sensor Black Level 2")
-                hdu.header["OFFSET_3"] = (SensorBlackLevels[3] * SensorBlackLevelScaling, "[DN] Sensor Black Level 3")
-        hdu.header["comment"] = img["comment"]
-        hdul = fits.HDUList([hdu])
-        # save FITS
-        hdul.writeto(output_filename, overwrite=True)
+            hdu.header[key] = (value, comment)
+    hdul = fits.HDUList([hdu])
+    # save FITS
+    hdul.writeto(output_filename, overwrite=True)
+
+
+def calibrate(img, calibration_folder=None):
+    """return frame calibrated with masters of calibration folder (see calibration.CalibrationLibrary.apply)"""
+    if calibration_folder is None:
+        return img
+    return calibration.get_Library(calibration_folder).apply(img)
+
+
+def convert(input_filename, remove, skip_existing, backend="native", verify=False, calibration_folder=None):
+    base_filename = input_filename.rsplit(".", maxsplit=1)[0]
+    if pifcap_sequence.is_Sequence(input_filename):
+        # sequence file: one FITS per frame
+        with pifcap_sequence.SequenceReader(input_filename) as seq:
+            for idx, img in enumerate(seq):
+                output_filename = f'{base_filename}-{idx:06d}.fits'
+                if not(skip_existing and os.path.isfile(output_filename)):
+                    write_FITS(calibrate(img, calibration_folder), output_filename, backend=backend, verify=verify)
+        # remove input if requested
+        if remove:
+            os.remove(input_filename)
+        return input_filename
+    output_filename = base_filename + ".fits"
+    if not(skip_existing and os.path.isfile(output_filename)):
+        # convert; pifcap renames files into place when complete, so they can be read right away
+        img = pifcap_image.Image.load(input_filename)
+        write_FITS(calibrate(img, calibration_folder), output_filename, backend=backend, verify=verify)
         # remove input if requested
         if remove:
             os.remove(input_filename)
     return input_filename
 
 
+def get_SequenceKey(input_filename, img):
+    """return key of frames belonging to the same recording sequence
+
+    Frames of a sequence share folder, file name prefix, raw mode, exposure time and gain. File names
+    written by pifcap are "{prefix}-{timestamp}.pfc" or "{prefix}-{timestamp}.pfcs".
+    """
+    Prefix = os.path.basename(input_filename).rsplit("-", maxsplit=1)[0]
+    metadata = img.metadata
+    return (
+        os.path.dirname(input_filename), Prefix, img.format, img.array.shape, tuple(metadata.get("Binning", ())),
+        metadata["ExposureTime"], metadata["AnalogueGain"],
+    )
+
+
+# output file name endings of sequence containers, distinct from the per-frame FITS files
+ContainerExtensions = {"cube": "-cube.fits", "mef": "-mef.fits", "ser": ".ser"}
+
+
+def open_Container(base_filename, container):
+    """return writer for one recording sequence
+
+    Args:
+        base_filename: output file name without extension
+        container: "cube", "mef" or "ser"
+    """
+    if container == "ser":
+        return serwriter.SERWriter(base_filename + ContainerExtensions[container])
+    return fitswriter.FITSCubeWriter(base_filename + ContainerExtensions[container], Container=container)
+
+
+def convert_Sequences(input_filenames, container, remove, skip_existing, verify=False, calibration_folder=None):
+    """convert frames to one FITS cube, multi-extension FITS or SER video file per recording sequence
+
+    Frames are streamed in order of file names; a new output file starts whenever the sequence key
+    (see `get_SequenceKey`) changes. The output is named after the first frame of the sequence with
+    ending "-cube.fits", "-mef.fits" or ".ser".
+
+    Args:
+        input_filenames: list of single frame and sequence files
+        container: "cube", "mef" (see fitswriter.FITSCubeWriter) or "ser" (see serwriter.SERWriter)
+        remove: remove input files after conversion
+        skip_existing: skip sequences when output exists
+        verify: check written FITS files with astropy (not for SER)
+        calibration_folder: folder with master calibration frames to apply, None for no calibration
+
+    Returns:
+        list of input file names
+    """
+    Writer = None
+    Key = None
+    # (input file name, frame index) of frames in current output, for verification only
+    Frames = list()
+
+    def finish():
+        Writer.close()
+        for i, (fn, idx) in enumerate(Frames):
+            img = calibrate(pifcap_sequence.load_Frame(fn, idx), calibration_folder)
+            if container == "cube":
+                fitswriter.verify_FITS(img, Writer.filename, HDU=0, Frame=i)
+            else:
+                fitswriter.verify_FITS(img, Writer.filename, HDU=i + 1)
+        Frames.clear()
+
+    try:
+        for input_filename, idx, img in pifcap_sequence.iter_Frames(input_filenames):
+            FrameKey = get_SequenceKey(input_filename, img)
+            if FrameKey != Key:
+                if Writer is not None:
+                    finish()
+                Key = FrameKey
+                base_filename = input_filename.rsplit(".", maxsplit=1)[0]
+                base_filename = f'{base_filename}-{idx:06d}' if idx else base_filename
+                if skip_existing and os.path.isfile(base_filename + ContainerExtensions[container]):
+                    Writer = None
+                else:
+                    Writer = open_Container(base_filename, container)
+            if Writer is not None:
+                Writer.append(calibrate(img, calibration_folder))
+                if verify and (container != "ser"):
+                    Frames.append((input_filename, idx))
+    finally:
+        if Writer is not None:
+            finish()
+    # remove input if requested
+    if remove:
+        for input_filename in input_filenames:
+            os.remove(input_filename)
+    return input_filenames
+
+
+# number of finished file names remembered to suppress duplicate events; files converted before are
+# found by their output files (see `main`)
+RecentlyFinishedLength = 10000
+
+
 def main():
+    if (len(sys.argv) > 1) and (sys.argv[1] == "calibrate"):
+        calibration.main(sys.argv[2:])
+        return
     # command line parser
     parser = argparse.ArgumentParser(description='convert pifcap to FITS')
     parser.add_argument('-s', '--skip_existing', action="store_true",
-                        help='skip conversion when output exists')
+                        help='skip conversion when output exists (always done for new files in demon mode without -r)')
     parser.add_argument('-r', '--remove', action="store_true",
                         help='remove input file after conversion')
     parser.add_argument('-d', '--demon', action="store_true",
                         help='convert existing files, stay running and convert all upcoming new files; exit with CTRL-C')
+    parser.add_argument('--poll', action="store_true",
+                        help='demon mode: poll folder instead of using inotify')
+    parser.add_argument('--poll_interval', type=float, default=1.0,
+                        help='demon mode: seconds between folder scans when polling (default: 1.0)')
+    parser.add_argument('--backend', choices=["native", "astropy"], default="native",
+                        help='FITS writer (default: native)')
+    parser.add_argument('--container', choices=["files", "cube", "mef", "ser"], default="files",
+                        help='files: one FITS file per frame; cube: one FITS cube per recording sequence; '
+                             'mef: one multi-extension FITS file per recording sequence; '
+                             'ser: one SER video per recording sequence (default: files); '
+                             'in demon mode only sequence files (*.pfcs) can be converted to containers')
+    parser.add_argument('-c', '--calibration', default=None,
+                        help='apply master frames from this calibration folder (see "pifcap2fits calibrate -h")')
+    parser.add_argument('--verify', action="store_true",
+                        help='check written FITS files with astropy')
     parser.add_argument('-j', '--jobs', type=int, default=1,
                         help='number of parallel running conversion jobs (default: 1)')
     parser.add_argument('-v', '--verbose', action="store_true",
                         help='verbose messages')
     parser.add_argument('files', metavar="path", default='*.pfc',
-                        help='files to convert; accepts "?", "*" and character ranges like "[a-z]" (default "*.pfc")')
+                        help='files to convert (single frames *.pfc or sequences *.pfcs); accepts "?", "*" and character ranges like "[a-z]" (default "*.pfc")')
     args = parser.parse_args()
+    if (args.container in ("cube", "mef")) and (args.backend != "native"):
+        parser.error(f'container {args.container} needs the native backend')
+    if (args.container != "files") and not args.demon:
+        # frames of all files get grouped to sequences, this needs a single job
+        input_filenames = [fn for fn in glob.glob(args.files) if os.path.isfile(fn)]
+        convert_Sequences(
+            input_filenames, args.container, args.remove, args.skip_existing, verify=args.verify,
+            calibration_folder=args.calibration,
+        )
+        if args.verbose:
+            print(f'{len(input_filenames)} files converted')
+        return
+    watcher = None
     if args.demon:
-        print("Demon mode. Exit with CTRL+C.")
-    # file lists
-    pending_files = list()
-    pending_processes = list()
-    finished_files = list()
+        # start watching before scanning existing files to not miss any file
+        try:
+            watcher = filewatch.FileWatcher(args.files, PollingPeriod=args.poll_interval, ForcePolling=args.poll)
+        except ValueError as e:
+            print(f'ERROR: {e}', file=sys.stderr)
+            sys.exit(1)
+        print(f'Demon mode ({"polling" if watcher.is_Polling else "inotify"}). Exit with CTRL+C.')
+    # file states
+    pending_files = set()
+    finished_queue = queue.SimpleQueue()
+    recently_finished = collections.OrderedDict()
+    n_finished = 0
     # multiprocessing pool
     pool = multiprocessing.Pool(processes=args.jobs)
-    # demon loop
-    while True:
-        # start conversion for all new input files
-        all_filenames = glob.glob(args.files)
-        for fn in all_filenames:
-            if (fn not in finished_files) and (fn not in pending_files):
-                pending_processes.append(
-                    pool.apply_async(
-                        convert,
-                        kwds={
-                            "input_filename": fn,
-                            "remove": args.remove,
-                            "skip_existing": args.skip_existing,
-                        }
-                    )
-                )
-                pending_files.append(fn)
-        # tell what is going on
-        if args.verbose:
-            print(f'{len(pending_processes)} files pending, {len(finished_files)} files converted   ', end='\r')
-        # release CPU
-        time.sleep(0.1)
-        # pending process loop
-        while len(pending_processes) > 0:
-            still_pending_processes = list()
-            for pp in pending_processes:
-                if pp.ready():
-                    finished_file = pp.get()
-                    finished_files.append(finished_file)
-                    pending_files.remove(finished_file)
-                else:
-                    still_pending_processes.append(pp)
-            pending_processes = still_pending_processes
-            if args.demon:
-                # demon mode allows to start more processes before pending are done
-                break
-            else:
-                # non-demon: stay in pending process loop
-                if args.verbose:
-                    print(f'{len(pending_processes)} files pending, {len(finished_files)} files converted   ', end='\r')
-                time.sleep(0.1)
-        # non-demon: finished
-        if not args.demon:
-            break
+
+    def submit(fn, skip_existing=args.skip_existing):
+        if (fn in pending_files) or (fn in recently_finished) or not os.path.isfile(fn):
+            return
+        pending_files.add(fn)
+        if args.container == "files":
+            pool.apply_async(
+                convert,
+                kwds={
+                    "input_filename": fn,
+                    "remove": args.remove,
+                    "skip_existing": skip_existing,
+                    "backend": args.backend,
+                    "verify": args.verify,
+                    "calibration_folder": args.calibration,
+                },
+                callback=finished_queue.put,
+                error_callback=lambda e, fn=fn: finished_queue.put((fn, e)),
+            )
+        elif not pifcap_sequence.is_Sequence(fn):
+            # demon mode: frames of single frame files can not be grouped while they arrive
+            finished_queue.put((fn, ValueError(f'--container {args.container} in demon mode needs sequence files (*.pfcs)')))
+        else:
+            # demon mode: every new sequence file is its own sequence
+            pool.apply_async(
+                convert_Sequences,
+                kwds={
+                    "input_filenames": [fn],
+                    "container": args.container,
+                    "remove": args.remove,
+                    "skip_existing": skip_existing,
+                    "verify": args.verify,
+                    "calibration_folder": args.calibration,
+                },
+                callback=lambda fns: finished_queue.put(fns[0]),
+                error_callback=lambda e, fn=fn: finished_queue.put((fn, e)),
+            )
+
+    # existing files
+    for fn in (glob.iglob(args.files) if watcher is None else watcher.scan()):
+        submit(fn)
+    # new files; a rescan after an inotify overflow reports converted files again: without removing the
+    # inputs they can be older than the recently finished window, their existing outputs are kept
+    skip_converted = args.skip_existing or not args.remove
+    try:
+        while args.demon or (len(pending_files) > 0):
+            if watcher is not None:
+                # sleeps until files arrive
+                for fn in watcher.wait(timeout=1.0):
+                    submit(fn, skip_existing=skip_converted)
+            # collect finished conversions
+            try:
+                finished = finished_queue.get(timeout=1.0) if watcher is None else finished_queue.get_nowait()
+                while True:
+                    if isinstance(finished, tuple):
+                        fn, e = finished
+                        print(f'ERROR: Can not convert {fn}: {e}', file=sys.stderr)
+                    else:
+                        fn = finished
+                    pending_files.discard(fn)
+                    recently_finished[fn] = None
+                    if len(recently_finished) > RecentlyFinishedLength:
+                        recently_finished.popitem(last=False)
+                    n_finished += 1
+                    finished = finished_queue.get_nowait()
+            except queue.Empty:
+                pass
+            # tell what is going on
+            if args.verbose:
+                print(f'{len(pending_files)} files pending, {n_finished} files converted   ', end='\r')
+    except KeyboardInterrupt:
+        pool.terminate()
+    else:
+        pool.close()
+    finally:
+        if watcher is not None:
+            watcher.close()
+    pool.join()
     print()
 
 
@@ -1,16 +1,260 @@
 """
 pifcap deticated image format
+
+File layout (all numbers little endian):
+    * fixed size header (see `_Header`)
+    * metadata block: UTF-8 encoded JSON with format, comment and frame metadata
+    * padding to next page boundary
+    * pixel data, row by row: raw (`ENCODING_RAW`) or, for 10 and 12 bit formats, bit packed
+      (`ENCODING_PACKED`, see `pack`)
+
+Files are written under a temporary name in the same folder and renamed when complete (see
+`get_TempName`). Other programs watching the folder see only finalized files.
+
+Files written by older pifcap versions (pickled dict) can still be loaded.
 """
 
+import os
+import re
 import pickle
+import struct
+import json
+import datetime
+import numpy as np
+
+# file identification and format version
+MAGIC = b"PIFCAP\x1a\n"
+VERSION = 1
+# pixel data encodings
+ENCODING_RAW = 0
+ENCODING_PACKED = 1
+# packed encoding: bit depth -> pixels per group of (pixels + 1) bytes
+_PackedGroups = {10: 4, 12: 2}
+# groups per conversion block, small enough to stay in CPU cache
+PackBlockGroups = 2 ** 15
+# pixel data start at a multiple of this
+PAGE_SIZE = 4096
+# typical size of metadata block, used for file size estimation
+METADATA_SIZE = 1024
+# files being written are hidden and have this suffix
+TEMP_PREFIX = "."
+TEMP_SUFFIX = ".part"
+
+# magic, version, encoding, height, width, dtype, metadata size, data offset, data size
+_Header = struct.Struct("<8sHHII4sIQQ")
+
+
+class IncompleteFileError(EOFError):
+    """file is truncated or still being written"""
+    pass
+
+
+def _encode_Metadata(obj):
+    """JSON encoder for metadata values not supported by json"""
+    if isinstance(obj, datetime.datetime):
+        return {"__datetime__": obj.isoformat()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    # for instance libcamera enums
+    return str(obj)
+
+
+def _decode_Metadata(d):
+    """JSON decoder hook restoring datetime objects"""
+    if "__datetime__" in d:
+        return datetime.datetime.fromisoformat(d["__datetime__"])
+    return d
+
+
+def get_TempName(filename):
+    """return name in the same folder under which a file is written before it gets renamed to filename"""
+    Folder, Name = os.path.split(filename)
+    return os.path.join(Folder, f'{TEMP_PREFIX}{Name}{TEMP_SUFFIX}')
+
+
+def is_TempName(filename):
+    """check if filename is the temporary name of a file being written"""
+    Name = os.path.basename(filename)
+    return Name.startswith(TEMP_PREFIX) and Name.endswith(TEMP_SUFFIX)
+
+
+def get_BitDepth(format):
+    """return bit depth of uncompressed raw format string or None"""
+    if (not format) or ("_" in format):
+        return None
+    m = re.search("[0-9]+", format)
+    return None if m is None else int(m.group())
+
+
+def parse_Format(format):
+    """return (Bayer pattern or None, bit depth) of raw format string
+
+    Raises:
+        NotImplementedError: for compressed or unknown formats
+    """
+    # we expect uncompressed format here
+    if format.count("_") > 0:
+        raise NotImplementedError(f'got unsupported raw image format {format}')
+    if format[0] not in ["S", "R"]:
+        raise NotImplementedError(f'got unsupported raw image format {format}')
+    # Bayer or mono format
+    if format[0] == "S":
+        # Bayer pattern format
+        return format[1:5], int(format[5:])
+    # mono format
+    return None, int(format[1:])
+
+
+def is_Packable(format):
+    """check if pixel data of raw format can be stored bit packed"""
+    return get_BitDepth(format) in _PackedGroups
+
+
+def get_PackedSize(nPixels, bit_depth):
+    """return number of bytes of nPixels packed pixels"""
+    G = _PackedGroups[bit_depth]
+    return -(-nPixels // G) * (G + 1)
+
+
+def pack(pixels, bit_depth):
+    """pack 10 or 12 bit pixels
+
+    Layout like MIPI CSI-2 packed formats: a group of 4 (10 bit) or 2 (12 bit) pixels is stored as the
+    upper 8 bits of each pixel followed by one byte with the lower bits of all pixels of the group.
+    Conversion runs block by block with a small scratch buffer.
+
+    Args:
+        pixels: uint16 array with values in the lower bit_depth bits
+        bit_depth: 10 or 12
+
+    Returns:
+        1-dim uint8 array
+    """
+    G = _PackedGroups[bit_depth]
+    L = bit_depth - 8
+    Mask = (1 << L) - 1
+    Flat = np.ascontiguousarray(pixels).reshape(-1)
+    if Flat.size % G != 0:
+        # fill last group with zeros
+        Flat = np.concatenate([Flat, np.zeros(G - Flat.size % G, dtype=Flat.dtype)])
+    Groups = Flat.reshape(-1, G)
+    Packed = np.empty((Groups.shape[0], G + 1), dtype=np.uint8)
+    Scratch = np.empty(min(PackBlockGroups, Groups.shape[0]), dtype=np.uint16)
+    for i in range(0, Groups.shape[0], PackBlockGroups):
+        q = Groups[i:i + PackBlockGroups]
+        o = Packed[i:i + PackBlockGroups]
+        s = Scratch[:q.shape[0]]
+        o[:, G] = 0
+        for k in range(G):
+            np.right_shift(q[:, k], L, out=o[:, k], casting="unsafe")
+            np.bitwise_and(q[:, k], Mask, out=s)
+            np.left_shift(s, L * k, out=s)
+            np.bitwise_or(o[:, G], s, out=o[:, G], casting="unsafe")
+    return Packed.reshape(-1)
+
+
+def unpack(data, bit_depth, nPixels):
+    """unpack pixels packed with `pack`
+
+    Args:
+        data: uint8 array or buffer with packed pixels
+        bit_depth: 10 or 12
+        nPixels: number of pixels
+
+    Returns:
+        1-dim uint16 array
+    """
+    G = _PackedGroups[bit_depth]
+    L = bit_depth - 8
+    Mask = (1 << L) - 1
+    Groups = np.frombuffer(data, dtype=np.uint8)[:get_PackedSize(nPixels, bit_depth)].reshape(-1, G + 1)
+    Pixels = np.empty((Groups.shape[0], G), dtype=np.uint16)
+    Scratch = np.empty(min(PackBlockGroups, Groups.shape[0]), dtype=np.uint16)
+    for i in range(0, Groups.shape[0], PackBlockGroups):
+        q = Groups[i:i + PackBlockGroups]
+        o = Pixels[i:i + PackBlockGroups]
+        s = Scratch[:q.shape[0]]
+        for k in range(G):
+            np.left_shift(q[:, k], L, out=o[:, k], dtype=np.uint16)
+            np.right_shift(q[:, G], L * k, out=s, dtype=np.uint16)
+            np.bitwise_and(s, Mask, out=s)
+            np.bitwise_or(o[:, k], s, out=o[:, k])
+    return Pixels.reshape(-1)[:nPixels]
+
+
+def _align(n, alignment=PAGE_SIZE):
+    """round n up to next multiple of alignment"""
+    return ((n + alignment - 1) // alignment) * alignment
+
+
+def estimate_FileSize(shape, dtype, packed_bit_depth=None):
+    """estimate size of file with a single image
+
+    Args:
+        shape: shape of pixel array
+        dtype: data type of pixel array
+        packed_bit_depth: bit depth of packed pixels (10 or 12), None for raw encoding
+
+    Returns:
+        file size in bytes
+    """
+    DataSize = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if packed_bit_depth is not None:
+        DataSize = get_PackedSize(DataSize // 2, packed_bit_depth)
+    return _align(_Header.size + METADATA_SIZE) + DataSize
+
 
 class Image:
-    def __init__(self, array=None, metadata=None, format=None, comment=None):
-        self.array = array
+    def __init__(self, array=None, metadata=None, format=None, comment=None, encoding=ENCODING_RAW, packed=None):
+        self._array = array
+        # packed pixel data (data, shape, dtype) of a read image, unpacked when needed
+        self._Packed = packed
         self.metadata = metadata
         self.format =format
         self.comment = comment
+        # pixel encoding when writing; ENCODING_PACKED falls back to raw for formats which can not be packed
+        self.encoding = encoding
 
+    @property
+    def array(self):
+        """pixel array; packed pixel data get unpacked at first access"""
+        if self._array is None and self._Packed is not None:
+            Data, shape, dtype = self._Packed
+            nPixels = shape[0] * shape[1] * dtype.itemsize // 2
+            self._array = unpack(Data, get_BitDepth(self.format), nPixels).view(dtype).reshape(shape)
+            self._Packed = None
+        return self._array
+
+    @array.setter
+    def array(self, array):
+        self._array = array
+        self._Packed = None
+
+    @property
+    def shape(self):
+        """shape of pixel array, without unpacking packed pixel data"""
+        if self._array is None and self._Packed is not None:
+            return self._Packed[1]
+        return self._array.shape
+
+    def get_Rows(self, start, stop):
+        """return rows start to stop of the pixel array
+
+        Packed pixel data which are not unpacked yet get unpacked for these rows only.
+        """
+        if self._array is not None or self._Packed is None:
+            return self.array[start:stop]
+        Data, shape, dtype = self._Packed
+        start, stop, _ = slice(start, stop).indices(shape[0])
+        stop = max(start, stop)
+        bit_depth = get_BitDepth(self.format)
+        G = _PackedGroups[bit_depth]
+        RowPixels = shape[1] * dtype.itemsize // 2
+        # groups covering the pixel range of the rows
+        p0, p1 = start * RowPixels, stop * RowPixels
+        g0, g1 = p0 // G, -(-p1 // G)
+        Pixels = unpack(Data[g0 * (G + 1):g1 * (G + 1)], bit_depth, (g1 - g0) * G)
+        return Pixels[p0 - g0 * G:p1 - g0 * G].view(dtype).reshape((stop - start, shape[1]))
 
     def get(self):
         Img = {
@@ -21,9 +265,211 @@ class Image:
         }
         return Img
 
+    def is_Packed(self):
+        """check if pixel data get written bit packed"""
+        return (self.encoding == ENCODING_PACKED) and is_Packable(self.format)
+
     def estimate_FileSize(self):
-        return len(pickle.dumps(self.get()))
-    
-    def save(self, filename):
-        with open(filename, "wb") as fh:
-            pickle.dump(self.get(), fh)
+        return estimate_FileSize(
+            self.array.shape, self.array.dtype, packed_bit_depth=get_BitDepth(self.format) if self.is_Packed() else None,
+        )
+
+    def encode_Header(self, offset=0):
+        """build file header and metadata block
+
+        Args:
+            offset: file position where the header will be written; pixel data get aligned to
+                page boundaries relative to the file start
+
+        Returns:
+            (bytes with header, metadata and padding, contiguous pixel data array)
+        """
+        array = np.ascontiguousarray(self.array)
+        if array.ndim != 2:
+            raise ValueError(f'can only store 2-dimensional arrays, got shape {array.shape}')
+        # header describes the unpacked array
+        Shape, Dtype = array.shape, array.dtype
+        if self.is_Packed():
+            Encoding = ENCODING_PACKED
+            array = pack(array.view(np.uint16), get_BitDepth(self.format))
+        else:
+            Encoding = ENCODING_RAW
+        MetaBlock = json.dumps(
+            {"format": self.format, "comment": self.comment, "metadata": self.metadata},
+            default=_encode_Metadata, separators=(",", ":"),
+        ).encode("utf-8")
+        DataOffset = _align(offset + _Header.size + len(MetaBlock)) - offset
+        Header = _Header.pack(
+            MAGIC, VERSION, Encoding,
+            Shape[0], Shape[1], Dtype.str.encode("ascii"),
+            len(MetaBlock), DataOffset, array.nbytes,
+        )
+        Padding = bytes(DataOffset - _Header.size - len(MetaBlock))
+        return Header + MetaBlock + Padding, array
+
+    def write(self, fh, on_Serialized=None):
+        """write image to open binary file
+
+        The raw pixel buffer is handed to the file without serialization copy.
+
+        Args:
+            fh: binary file
+            on_Serialized: optional function called when header and metadata are encoded
+
+        Returns:
+            number of bytes written
+        """
+        HeaderBlock, array = self.encode_Header(offset=fh.tell())
+        if on_Serialized is not None:
+            on_Serialized()
+        fh.write(HeaderBlock)
+        fh.write(array.data)
+        return len(HeaderBlock) + array.nbytes
+
+    def save(self, filename, on_Serialized=None):
+        """save image to file
+
+        The image is written to a temporary name and atomically renamed to filename when complete.
+
+        Args:
+            filename: name of file
+            on_Serialized: optional function called when header and metadata are encoded
+
+        Returns:
+            number of bytes written
+        """
+        TempName = get_TempName(filename)
+        try:
+            with open(TempName, "wb") as fh:
+                nBytes = self.write(fh, on_Serialized=on_Serialized)
+            os.replace(TempName, filename)
+        except BaseException:
+            # do not leave incomplete files behind
+            try:
+                os.remove(TempName)
+            except OSError:
+                pass
+            raise
+        return nBytes
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """load image from file
+
+        Args:
+            filename: name of file
+            mmap: map pixel data with np.memmap instead of reading them
+
+        Returns:
+            Image
+        """
+        with open(filename, "rb") as fh:
+            magic = fh.read(len(MAGIC))
+            if magic != MAGIC:
+                # file written by old pifcap version
+                fh.seek(0)
+                Img = pickle.load(fh)
+                return cls(array=Img["array"], metadata=Img["metadata"], format=Img["format"], comment=Img["comment"])
+            fh.seek(0)
+            return cls.read(fh, filename=filename if mmap else None)
+
+    @classmethod
+    def read(cls, fh, filename=None):
+        """read image from open binary file at current position
+
+        Args:
+            fh: binary file
+            filename: when given the pixel data get memory mapped from this file (packed pixel data get
+                unpacked into memory at first access of the pixel array, see `Image.get_Rows`)
+
+        Returns:
+            Image
+        """
+        offset = fh.tell()
+        HeaderBytes = fh.read(_Header.size)
+        if len(HeaderBytes) < _Header.size:
+            raise IncompleteFileError(f'truncated header at file position {offset}')
+        magic, version, encoding, height, width, dtype, MetaSize, DataOffset, DataSize = _Header.unpack(HeaderBytes)
+        if magic != MAGIC:
+            raise ValueError(f'no pifcap image at file position {offset}')
+        if version > VERSION:
+            raise NotImplementedError(f'pifcap image format version {version} not supported')
+        if encoding not in (ENCODING_RAW, ENCODING_PACKED):
+            raise NotImplementedError(f'pifcap pixel encoding {encoding} not supported')
+        MetaBlock = fh.read(MetaSize)
+        if len(MetaBlock) < MetaSize:
+            raise IncompleteFileError(f'truncated metadata at file position {offset}')
+        Meta = json.loads(MetaBlock.decode("utf-8"), object_hook=_decode_Metadata)
+        dtype = np.dtype(dtype.rstrip(b"\x00").decode("ascii"))
+        DataStart = offset + DataOffset
+        fh.seek(0, 2)
+        if fh.tell() < DataStart + DataSize:
+            raise IncompleteFileError(f'truncated pixel data at file position {offset}')
+        if encoding == ENCODING_PACKED:
+            if filename is not None:
+                Data = np.memmap(filename, dtype=np.uint8, mode="r", offset=DataStart, shape=(DataSize,))
+            else:
+                fh.seek(DataStart)
+                Data = fh.read(DataSize)
+            fh.seek(DataStart + DataSize)
+            return cls(
+                metadata=Meta["metadata"], format=Meta["format"], comment=Meta["comment"], encoding=encoding,
+                packed=(np.frombuffer(Data, dtype=np.uint8), (height, width), dtype),
+            )
+        if filename is not None:
+            array = np.memmap(filename, dtype=dtype, mode="r", offset=DataStart, shape=(height, width))
+        else:
+            fh.seek(DataStart)
+            array = np.frombuffer(fh.read(DataSize), dtype=dtype).reshape((height, width))
+        fh.seek(DataStart + DataSize)
+        return cls(
+            array=array, metadata=Meta["metadata"], format=Meta["format"], comment=Meta["comment"], encoding=encoding,
+        )
+
+
+if __name__ == "__main__":
+    # benchmark: pack and write against writing raw 16 bit containers
+    #   python -m pifcap.pifcap_image [folder on storage to test]
+    import sys
+    import time
+    import tempfile
+    rng = np.random.default_rng(0)
+    nFrames = 10
+    Width, Height = 4056, 3040
+    Folder = sys.argv[1] if len(sys.argv) > 1 else None
+    with tempfile.TemporaryDirectory(dir=Folder) as Folder:
+        for format in ["SRGGB10", "SRGGB12"]:
+            bit_depth = get_BitDepth(format)
+            array = rng.integers(0, 2 ** bit_depth, size=(Height, Width), dtype=np.uint16).view(np.uint8)
+            Results = dict()
+            for name, encoding in [("raw", ENCODING_RAW), ("packed", ENCODING_PACKED)]:
+                Img = Image(array=array, metadata={}, format=format, comment="", encoding=encoding)
+                nBytes = 0
+                t0 = time.perf_counter()
+                for i in range(nFrames):
+                    filename = os.path.join(Folder, f'{name}-{i}.pfc')
+                    with open(filename, "wb") as fh:
+                        nBytes += Img.write(fh)
+                        fh.flush()
+                        # include time until data are on the storage
+                        os.fsync(fh.fileno())
+                dt = time.perf_counter() - t0
+                Results[name] = (nBytes, dt)
+                print(f'{format} {name:6s}: {nFrames / dt:6.1f} frames/s, {nBytes / dt / 1e6:7.1f} MB/s written')
+                if encoding == ENCODING_PACKED:
+                    Loaded = Image.load(filename)
+                    assert np.array_equal(Loaded.array, array), "unpacked pixels differ"
+                for i in range(nFrames):
+                    os.remove(os.path.join(Folder, f'{name}-{i}.pfc'))
+            # pack cost alone
+            t0 = time.perf_counter()
+            for i in range(nFrames):
+                pack(array.view(np.uint16), bit_depth)
+            PackTime = (time.perf_counter() - t0) / nFrames
+            SavedBytes = (Results["raw"][0] - Results["packed"][0]) / nFrames
+            print(
+                f'{format}: pack {PackTime * 1e3:.1f} ms/frame, saves {SavedBytes / 1e6:.1f} MB/frame; '
+                f'packing pays off on storage slower than {SavedBytes / PackTime / 1e6:.0f} MB/s, '
+                f'speedup here {Results["raw"][1] / Results["packed"][1]:.2f}'
+            )
+    sys.exit(0)
@@ -0,0 +1,193 @@
+"""
+pifcap sequence format: all frames of a recording run in one file
+
+File layout (all numbers little endian):
+    * file header (see `_FileHeader`)
+    * frames appended back to back, each in the layout of a single pifcap image (see `pifcap_image`)
+      with pixel data aligned to page boundaries
+    * frame index: one `_IndexEntry` (file offset, UTC timestamp) per frame
+    * footer (see `_Footer`) pointing to the frame index
+
+The file is written under a temporary name (see `pifcap_image.get_TempName`) and renamed when the
+sequence gets closed. A sequence without index (for instance the temporary file left behind when the
+recording program crashed) can still be read; the index is rebuilt by scanning the frame headers.
+"""
+
+import os
+import struct
+import threading
+
+from . import pifcap_image
+
+# file identification and format version
+MAGIC = b"PIFCSEQ\n"
+INDEX_MAGIC = b"PIFCIDX\n"
+VERSION = 1
+
+# magic, version, flags
+_FileHeader = struct.Struct("<8sHH")
+# frame offset, timestamp (POSIX seconds of DateEnd)
+_IndexEntry = struct.Struct("<Qd")
+# magic, number of frames, index offset
+_Footer = struct.Struct("<8sQQ")
+
+
+def is_Sequence(filename):
+    """check if file is a pifcap sequence"""
+    with open(filename, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def _get_Timestamp(Img):
+    """return POSIX timestamp of frame end or NaN if unknown"""
+    try:
+        return Img.metadata["DateEnd"].timestamp()
+    except (KeyError, TypeError, AttributeError):
+        return float("nan")
+
+
+def load_Frame(filename, idx=None):
+    """return frame idx of a sequence file or image of a single frame file (idx is None)"""
+    if idx is None:
+        return pifcap_image.Image.load(filename)
+    with SequenceReader(filename) as seq:
+        return seq[idx]
+
+
+def iter_Frames(filenames):
+    """yield (file name, frame index or None, image) of all frames of single frame and sequence files
+
+    Files are read in order of their names; single frame files have frame index None.
+    """
+    for filename in sorted(filenames):
+        if is_Sequence(filename):
+            with SequenceReader(filename) as seq:
+                for idx, img in enumerate(seq):
+                    yield filename, idx, img
+        else:
+            yield filename, None, pifcap_image.Image.load(filename)
+
+
+class SequenceWriter:
+    """append-only writer for pifcap sequence files
+
+    The file is created with the first frame under a temporary name and renamed when closing.
+    Appending is thread safe.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = None
+        self._Index = list()
+        self._Lock = threading.Lock()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._Index)
+
+    def append(self, Img, on_Serialized=None):
+        """append frame
+
+        Args:
+            Img: pifcap_image.Image
+            on_Serialized: optional function called when header and metadata are encoded
+
+        Returns:
+            number of bytes written
+        """
+        with self._Lock:
+            if self._closed:
+                raise ValueError(f'sequence {self.filename} is already closed')
+            if self._fh is None:
+                self._fh = open(pifcap_image.get_TempName(self.filename), "wb")
+                self._fh.write(_FileHeader.pack(MAGIC, VERSION, 0))
+            offset = self._fh.tell()
+            nBytes = Img.write(self._fh, on_Serialized=on_Serialized)
+            self._Index.append((offset, _get_Timestamp(Img)))
+            return nBytes
+
+    def close(self):
+        """write frame index and close file
+        """
+        with self._Lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._fh is None:
+                # no frame recorded
+                return
+            IndexOffset = self._fh.tell()
+            self._fh.write(b"".join(_IndexEntry.pack(*e) for e in self._Index))
+            self._fh.write(_Footer.pack(INDEX_MAGIC, len(self._Index), IndexOffset))
+            self._fh.close()
+            self._fh = None
+            os.replace(pifcap_image.get_TempName(self.filename), self.filename)
+
+
+class SequenceReader:
+    """random access to frames of a pifcap sequence file
+    """
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        self.mmap = mmap
+        self._fh = open(filename, "rb")
+        magic, version, flags = _FileHeader.unpack(self._fh.read(_FileHeader.size))
+        if magic != MAGIC:
+            self._fh.close()
+            raise ValueError(f'{filename} is not a pifcap sequence')
+        if version > VERSION:
+            self._fh.close()
+            raise NotImplementedError(f'pifcap sequence format version {version} not supported')
+        self.offsets, self.timestamps = self._read_Index()
+
+    def _read_Index(self):
+        """read frame index from file end or rebuild it by scanning all frames"""
+        FileSize = os.fstat(self._fh.fileno()).st_size
+        if FileSize >= _FileHeader.size + _Footer.size:
+            self._fh.seek(FileSize - _Footer.size)
+            magic, nFrames, IndexOffset = _Footer.unpack(self._fh.read(_Footer.size))
+            if (magic == INDEX_MAGIC) and (IndexOffset + nFrames * _IndexEntry.size + _Footer.size == FileSize):
+                self._fh.seek(IndexOffset)
+                IndexBytes = self._fh.read(nFrames * _IndexEntry.size)
+                Index = list(_IndexEntry.iter_unpack(IndexBytes))
+                return [e[0] for e in Index], [e[1] for e in Index]
+        # no index: scan frames
+        offsets = list()
+        timestamps = list()
+        self._fh.seek(_FileHeader.size)
+        while True:
+            offset = self._fh.tell()
+            try:
+                Img = pifcap_image.Image.read(self._fh)
+            except (pifcap_image.IncompleteFileError, ValueError):
+                # end of (possibly truncated) data
+                break
+            offsets.append(offset)
+            timestamps.append(_get_Timestamp(Img))
+        return offsets, timestamps
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        """return frame idx as pifcap_image.Image"""
+        if idx < 0:
+            idx += len(self.offsets)
+        if not (0 <= idx < len(self.offsets)):
+            raise IndexError(f'frame {idx} not in sequence with {len(self.offsets)} frames')
+        self._fh.seek(self.offsets[idx])
+        return pifcap_image.Image.read(self._fh, filename=self.filename if self.mmap else None)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -122,6 +122,26 @@ class Ui_MainWindow(object):
         self.checkBox_OptimizeExposure = QtWidgets.QCheckBox(self.groupBox_CameraSettings)
         self.checkBox_OptimizeExposure.setObjectName("checkBox_OptimizeExposure")
         self.gridLayout_2.addWidget(self.checkBox_OptimizeExposure, 2, 2, 1, 1)
+        self.label_8 = QtWidgets.QLabel(self.groupBox_CameraSettings)
+        self.label_8.setObjectName("label_8")
+        self.gridLayout_2.addWidget(self.label_8, 3, 0, 1, 1)
+        self.spinBox_BufferCount = QtWidgets.QSpinBox(self.groupBox_CameraSettings)
+        self.spinBox_BufferCount.setMinimum(2)
+        self.spinBox_BufferCount.setMaximum(32)
+        self.spinBox_BufferCount.setObjectName("spinBox_BufferCount")
+        self.gridLayout_2.addWidget(self.spinBox_BufferCount, 3, 1, 1, 1)
+        self.label_DroppedFrames = QtWidgets.QLabel(self.groupBox_CameraSettings)
+        self.label_DroppedFrames.setObjectName("label_DroppedFrames")
+        self.gridLayout_2.addWidget(self.label_DroppedFrames, 3, 2, 1, 2)
+        self.label_9 = QtWidgets.QLabel(self.groupBox_CameraSettings)
+        self.label_9.setObjectName("label_9")
+        self.gridLayout_2.addWidget(self.label_9, 4, 0, 1, 1)
+        self.comboBox_Metering = QtWidgets.QComboBox(self.groupBox_CameraSettings)
+        self.comboBox_Metering.setObjectName("comboBox_Metering")
+        self.comboBox_Metering.addItem("")
+        self.comboBox_Metering.addItem("")
+        self.comboBox_Metering.addItem("")
+        self.gridLayout_2.addWidget(self.comboBox_Metering, 4, 1, 1, 3)
         self.verticalLayout_6.addWidget(self.groupBox_CameraSettings)
         self.groupBox_4 = QtWidgets.QGroupBox(self.scrollAreaWidgetContents_3)
         self.groupBox_4.setObjectName("groupBox_4")
@@ -154,6 +174,15 @@ class Ui_MainWindow(object):
         self.checkBox_Saturation.setChecked(True)
         self.checkBox_Saturation.setObjectName("checkBox_Saturation")
         self.gridLayout_3.addWidget(self.checkBox_Saturation, 1, 1, 1, 2)
+        self.checkBox_LiveStack = QtWidgets.QCheckBox(self.groupBox_4)
+        self.checkBox_LiveStack.setObjectName("checkBox_LiveStack")
+        self.gridLayout_3.addWidget(self.checkBox_LiveStack, 2, 0, 1, 1)
+        self.checkBox_StackRegister = QtWidgets.QCheckBox(self.groupBox_4)
+        self.checkBox_StackRegister.setObjectName("checkBox_StackRegister")
+        self.gridLayout_3.addWidget(self.checkBox_StackRegister, 2, 1, 1, 2)
+        self.label_PreviewInfos = QtWidgets.QLabel(self.groupBox_4)
+        self.label_PreviewInfos.setObjectName("label_PreviewInfos")
+        self.gridLayout_3.addWidget(self.label_PreviewInfos, 3, 0, 1, 3)
         self.verticalLayout_6.addWidget(self.groupBox_4)
         self.groupBox = QtWidgets.QGroupBox(self.scrollAreaWidgetContents_3)
         self.groupBox.setObjectName("groupBox")
@@ -224,6 +253,13 @@ class Ui_MainWindow(object):
         self.comboBox_FrameType.addItem("")
         self.comboBox_FrameType.addItem("")
         self.gridLayout.addWidget(self.comboBox_FrameType, 1, 1, 1, 6)
+        self.label_WriterInfos = QtWidgets.QLabel(self.groupBox)
+        self.label_WriterInfos.setText("")
+        self.label_WriterInfos.setObjectName("label_WriterInfos")
+        self.gridLayout.addWidget(self.label_WriterInfos, 6, 0, 1, 7)
+        self.checkBox_ROI = QtWidgets.QCheckBox(self.groupBox)
+        self.checkBox_ROI.setObjectName("checkBox_ROI")
+        self.gridLayout.addWidget(self.checkBox_ROI, 7, 0, 1, 7)
         self.verticalLayout_6.addWidget(self.groupBox)
         spacerItem = QtWidgets.QSpacerItem(20, 40, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
         self.verticalLayout_6.addItem(spacerItem)
@@ -256,6 +292,13 @@ class Ui_MainWindow(object):
         self.doubleSpinBox_ExposureTime.setSuffix(_translate("MainWindow", " s"))
         self.label_5.setText(_translate("MainWindow", "gain:"))
         self.checkBox_OptimizeExposure.setText(_translate("MainWindow", "optimize"))
+        self.label_8.setText(_translate("MainWindow", "buffers:"))
+        self.spinBox_BufferCount.setToolTip(_translate("MainWindow", "number of camera buffers for this raw mode"))
+        self.label_DroppedFrames.setText(_translate("MainWindow", "0 frames dropped"))
+        self.label_9.setText(_translate("MainWindow", "metering:"))
+        self.comboBox_Metering.setItemText(0, _translate("MainWindow", "full frame"))
+        self.comboBox_Metering.setItemText(1, _translate("MainWindow", "manual ROI"))
+        self.comboBox_Metering.setItemText(2, _translate("MainWindow", "brightest blob"))
         self.groupBox_4.setTitle(_translate("MainWindow", "Display"))
         self.checkBox_PreviewFlipH.setText(_translate("MainWindow", "flip H"))
         self.checkBox_PreviewFlipV.setText(_translate("MainWindow", "flip V"))
@@ -269,6 +312,11 @@ class Ui_MainWindow(object):
         self.comboBox_RawPreviewMode.setItemText(3, _translate("MainWindow", "green 2"))
         self.comboBox_RawPreviewMode.setItemText(4, _translate("MainWindow", "blue"))
         self.checkBox_Saturation.setText(_translate("MainWindow", "saturation"))
+        self.checkBox_LiveStack.setToolTip(_translate("MainWindow", "show average of all frames since last mode or settings change"))
+        self.checkBox_LiveStack.setText(_translate("MainWindow", "live stack"))
+        self.checkBox_StackRegister.setToolTip(_translate("MainWindow", "align frames to first frame of stack"))
+        self.checkBox_StackRegister.setText(_translate("MainWindow", "register"))
+        self.label_PreviewInfos.setText(_translate("MainWindow", "preview:"))
         self.groupBox.setTitle(_translate("MainWindow", "Recording"))
         self.label_3.setText(_translate("MainWindow", "Prefix:"))
         self.label_RecordedImageCounter.setText(_translate("MainWindow", "0 images saved"))
@@ -284,6 +332,8 @@ class Ui_MainWindow(object):
         self.comboBox_FrameType.setItemText(1, _translate("MainWindow", "Dark"))
         self.comboBox_FrameType.setItemText(2, _translate("MainWindow", "Flat"))
         self.comboBox_FrameType.setItemText(3, _translate("MainWindow", "Bias"))
+        self.checkBox_ROI.setToolTip(_translate("MainWindow", "store only the region of interest marked in the preview"))
+        self.checkBox_ROI.setText(_translate("MainWindow", "record ROI only"))
         self.action_DarkNoiseMeasurement.setText(_translate("MainWindow", "Dark Noise Measurement"))
 from pyqtgraph import ImageView
 
@@ -0,0 +1,272 @@
+"""
+frame quality scoring and selection for lucky imaging
+
+Frames get a sharpness score in worker threads (NumPy releases the GIL). Depending on the selection
+mode only frames above a threshold or the best frames within a rolling window are handed to the
+frame writer, in the order they were captured.
+"""
+
+import threading
+import collections
+import time
+import concurrent.futures
+import numpy as np
+
+from . import pifcap_image
+
+settings = {'name': 'frame selection', 'type': 'group', 'children': [
+    {
+        'name': 'mode', 'type': 'list', 'values': ['off', 'score only', 'above threshold', 'best in window'],
+        'value': 'off',
+        'tip': 'off: no scoring; score only: store sharpness in metadata; above threshold, best in window: record only selected frames',
+    },
+    {
+        'name': 'threshold', 'type': 'float', 'value': 0.01, 'limits': [0, 1e6],
+        'tip': 'minimum sharpness of recorded frames (mode "above threshold")',
+    },
+    {
+        'name': 'keep percentage', 'type': 'float', 'value': 10.0, 'limits': [0.1, 100], 'suffix': ' %',
+        'tip': 'percentage of best frames to record (mode "best in window")',
+    },
+    {
+        'name': 'window length', 'type': 'int', 'value': 100, 'limits': [2, 10000], 'suffix': ' frames',
+        'tip': 'number of recent frames to compare with (mode "best in window")',
+    },
+    {
+        'name': 'decimation', 'type': 'int', 'value': 2, 'limits': [1, 16],
+        'tip': 'use only every n-th pixel of the color channel to compute sharpness',
+    },
+    {
+        'name': 'worker threads', 'type': 'int', 'value': 2, 'limits': [1, 8],
+        'tip': 'number of threads computing sharpness; when scoring falls behind the queue full policy of the frame writer applies '
+               '(both drop policies drop the new frame)',
+    },
+]}
+
+
+def get_ScoringPlane(array, format, decimation=1):
+    """return decimated green Bayer channel or mono image as view of raw array
+
+    Args:
+        array: raw image array
+        format: raw format string
+        decimation: use every n-th pixel of the channel
+
+    Returns:
+        2-dim array view
+    """
+    BayerPattern, bit_depth = pifcap_image.parse_Format(format)
+    array = array.view(np.uint16) if bit_depth > 8 else array.view(np.uint8)
+    if BayerPattern is None:
+        return array[::decimation, ::decimation]
+    # first green pixel in Bayer pattern
+    g = BayerPattern.index("G")
+    return array[g // 2::2 * decimation, g % 2::2 * decimation]
+
+
+def sharpness(array, format, decimation=1):
+    """normalized gradient energy of a frame
+
+    Gradient energy of the green channel divided by the squared mean brightness. The normalization
+    makes the score insensitive to brightness changes.
+
+    Args:
+        array: raw image array
+        format: raw format string
+        decimation: use every n-th pixel of the channel
+
+    Returns:
+        sharpness score
+    """
+    plane = get_ScoringPlane(array, format, decimation).astype(np.float32)
+    gx = plane[:, 1:] - plane[:, :-1]
+    gy = plane[1:, :] - plane[:-1, :]
+    energy = np.einsum("ij,ij->", gx, gx) / gx.size + np.einsum("ij,ij->", gy, gy) / gy.size
+    mean = plane.mean()
+    return float(energy / max(mean * mean, 1.0))
+
+
+class FrameSelector:
+    """scores frames in worker threads and hands selected frames to the frame writer
+    """
+
+    Modes = ('off', 'score only', 'above threshold', 'best in window')
+
+    def __init__(self, FrameWriter, Mode='score only', Threshold=0.01, KeepPercentage=10.0, WindowLength=100,
+                 Decimation=2, nThreads=2, MaxPending=8):
+        if Mode not in self.Modes:
+            raise ValueError(f'unknown frame selection mode {Mode}')
+        self.FrameWriter = FrameWriter
+        self.Mode = Mode
+        self.Threshold = Threshold
+        self.KeepPercentage = KeepPercentage
+        self.Decimation = Decimation
+        self._Window = collections.deque(maxlen=WindowLength)
+        self._Executor = concurrent.futures.ThreadPoolExecutor(max_workers=nThreads, thread_name_prefix='FrameSelector')
+        # limits number of frames waiting for scoring
+        self._PendingSlots = threading.BoundedSemaphore(MaxPending)
+        self._Lock = threading.Lock()
+        # frames in scoring per target and sequence files to close when their frames are scored
+        self._Pending = collections.Counter()
+        self._Closing = list()
+        # scored frames are released to the frame writer in order of their tickets
+        self._NextTicket = 0
+        self._NextRelease = 0
+        self._Scored = dict()
+        self._ReleaseLock = threading.Lock()
+        self.reset_Stats()
+
+    def reset_Stats(self):
+        """reset statistics counters
+        """
+        with self._Lock:
+            self._Kept = 0
+            self._Rejected = 0
+            self._LastScore = None
+            self._Errors = 0
+            self._LastError = None
+            self._Blocked = 0
+            self._BlockedTime = 0.0
+            self._Dropped = 0
+
+    def put(self, Img, Target):
+        """score frame and queue it for writing when selected
+
+        Args:
+            Img: pifcap_image.Image
+            Target: name of file or pifcap_sequence.SequenceWriter (see writer.FrameWriter.put)
+
+        When too many frames wait for scoring the queue full policy of the frame writer applies. Frames
+        in scoring can not be withdrawn: both drop policies drop the new frame.
+
+        Returns:
+            True when frame was queued for scoring, False when it was dropped
+        """
+        if not self._PendingSlots.acquire(blocking=False):
+            if self.FrameWriter.Policy != 'block':
+                with self._Lock:
+                    self._Dropped += 1
+                return False
+            t0 = time.monotonic()
+            self._PendingSlots.acquire()
+            with self._Lock:
+                self._Blocked += 1
+                self._BlockedTime += time.monotonic() - t0
+        # keep timing of frame until the frame writer takes it
+        self._hold_Timing(Img)
+        with self._Lock:
+            self._Pending[Target] += 1
+            Ticket = self._NextTicket
+            self._NextTicket += 1
+        self._Executor.submit(self._score, Img, Target, Ticket)
+        return True
+
+    def close(self, Target):
+        """close sequence file after all its frames are scored and written
+
+        Args:
+            Target: pifcap_sequence.SequenceWriter
+        """
+        with self._Lock:
+            if self._Pending[Target] > 0:
+                self._Closing.append(Target)
+                return
+        self.FrameWriter.close(Target)
+
+    def shutdown(self):
+        """finish scoring of all pending frames
+        """
+        self._Executor.shutdown(wait=True)
+
+    def get_Stats(self):
+        """return dict with selection statistics
+        """
+        with self._Lock:
+            return {
+                "kept": self._Kept,
+                "rejected": self._Rejected,
+                "last_score": self._LastScore,
+                "errors": self._Errors,
+                "last_error": self._LastError,
+                "blocked": self._Blocked,
+                "blocked_time": self._BlockedTime,
+                "dropped": self._Dropped,
+            }
+
+    def _hold_Timing(self, Img):
+        """hold pipeline timing of a frame, see timing.PipelineTiming.hold
+        """
+        FrameNumber = Img.metadata.get("FrameNumber", None)
+        if (self.FrameWriter.Timing is not None) and (FrameNumber is not None):
+            self.FrameWriter.Timing.hold(FrameNumber)
+
+    def _release_Timing(self, Img):
+        """release pipeline timing of a frame held by `put`
+        """
+        FrameNumber = Img.metadata.get("FrameNumber", None)
+        if (self.FrameWriter.Timing is not None) and (FrameNumber is not None):
+            self.FrameWriter.Timing.release(FrameNumber)
+
+    def _is_Selected(self, Score):
+        """decide if frame gets recorded; must be called with lock held
+        """
+        self._Window.append(Score)
+        if self.Mode == 'above threshold':
+            return Score >= self.Threshold
+        elif self.Mode == 'best in window':
+            return Score >= np.percentile(self._Window, 100 - self.KeepPercentage)
+        return True
+
+    def _score(self, Img, Target, Ticket):
+        """worker thread job
+        """
+        # frames which can not be scored get recorded unscored
+        is_Selected = True
+        try:
+            Score = sharpness(Img.array, Img.format, self.Decimation)
+            # metadata dict is shared with the preview: do not modify it in place
+            Img.metadata = dict(Img.metadata, Sharpness=Score)
+            with self._Lock:
+                is_Selected = self._is_Selected(Score)
+                self._LastScore = Score
+                if is_Selected:
+                    self._Kept += 1
+                else:
+                    self._Rejected += 1
+        except Exception as e:
+            with self._Lock:
+                self._Errors += 1
+                self._LastError = f'frame {Img.metadata.get("FrameNumber", "?")}: {e}'
+        finally:
+            with self._Lock:
+                self._Scored[Ticket] = (Img, Target, is_Selected)
+            self._release()
+
+    def _release(self):
+        """hand scored frames to the frame writer in the order they were put
+        """
+        with self._ReleaseLock:
+            while True:
+                with self._Lock:
+                    Scored = self._Scored.pop(self._NextRelease, None)
+                    if Scored is None:
+                        # next frame in order is still being scored
+                        return
+                    self._NextRelease += 1
+                Img, Target, is_Selected = Scored
+                try:
+                    if is_Selected:
+                        self.FrameWriter.put(Img, Target)
+                finally:
+                    self._release_Timing(Img)
+                    # slot is kept until release to bound the number of frames waiting for earlier ones
+                    self._PendingSlots.release()
+                    with self._Lock:
+                        self._Pending[Target] -= 1
+                        if self._Pending[Target] <= 0:
+                            del self._Pending[Target]
+                        is_Closing = (Target not in self._Pending) and any(t is Target for t in self._Closing)
+                        if is_Closing:
+                            self._Closing = [t for t in self._Closing if t is not Target]
+                    if is_Closing:
+                        self.FrameWriter.close(Target)
@@ -0,0 +1,165 @@
+"""
+streaming SER video writer for lucky imaging stacking software
+
+File layout (all numbers little endian, see SER format description version 3):
+    * 178 bytes header (see `_Header`), frame count patched when closing
+    * raw frames back to back in their native bit depth (8 bit or 16 bit containers)
+    * trailer with one UTC timestamp per frame (int64, 100 ns ticks since 0001-01-01)
+
+Frames are written as they come; the timestamps are spooled to a temporary file next to the video
+and appended when closing. Memory use does not grow with the number of frames. Like all pifcap
+recordings the video is written under a temporary name and renamed when closing.
+"""
+
+import os
+import datetime
+import tempfile
+import threading
+import struct
+import numpy as np
+
+from . import fitswriter
+from . import pifcap_image
+
+FILE_ID = b"LUCAM-RECORDER"
+
+# FileID, LuID, ColorID, LittleEndian, ImageWidth, ImageHeight, PixelDepthPerPlane, FrameCount,
+# Observer, Instrument, Telescope, DateTime, DateTime_UTC
+_Header = struct.Struct("<14siiiiiii40s40s40sqq")
+# file offset of FrameCount
+_FrameCountOffset = 38
+_Timestamp = struct.Struct("<q")
+
+# ColorID
+MONO = 0
+BayerColorIDs = {"RGGB": 8, "GRBG": 9, "GBRG": 10, "BGGR": 11}
+
+# SER epoch
+_Epoch = datetime.datetime(1, 1, 1)
+
+
+def to_Ticks(dt):
+    """return 100 ns ticks since 0001-01-01 of a naive or timezone aware datetime"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (dt - _Epoch) // datetime.timedelta(microseconds=1) * 10
+
+
+def get_ColorID(format, ROI=None):
+    """return SER ColorID of raw format string
+
+    Args:
+        format: raw format string like "SRGGB12" or "R8"
+        ROI: region of interest (x, y, width, height); an odd offset shifts the Bayer pattern
+    """
+    BayerPattern, bit_depth = pifcap_image.parse_Format(format)
+    if BayerPattern is None:
+        return MONO
+    if ROI is not None:
+        x, y = ROI[0] % 2, ROI[1] % 2
+        BayerPattern = "".join(BayerPattern[((i // 2 + y) % 2) * 2 + (i % 2 + x) % 2] for i in range(4))
+    return BayerColorIDs[BayerPattern]
+
+
+class SERWriter:
+    """append-only writer for SER video files
+
+    The file is created with the first frame. All frames must have the same raw format and size.
+    Appending is thread safe. Same interface as `pifcap_sequence.SequenceWriter`.
+    """
+
+    def __init__(self, filename, Observer="", Telescope=""):
+        self.filename = filename
+        self.Observer = Observer
+        self.Telescope = Telescope
+        self._fd = None
+        self._Timestamps = None
+        self._nFrames = 0
+        self._Geometry = None
+        self._Lock = threading.Lock()
+        self._closed = False
+
+    def __len__(self):
+        return self._nFrames
+
+    def _open(self, Img, array, bit_depth):
+        """create file and write header"""
+        metadata = Img.metadata
+        DateEnd = metadata["DateEnd"]
+        Header = _Header.pack(
+            FILE_ID, 0,
+            get_ColorID(Img.format, metadata.get("ROI", None)),
+            # 0 for little endian 16 bit data, as written and expected by common capture and stacking software
+            0,
+            array.shape[1], array.shape[0], bit_depth, 0,
+            self.Observer.encode("ascii", "replace")[:40],
+            str(metadata.get("CameraModel", "")).encode("ascii", "replace")[:40],
+            self.Telescope.encode("ascii", "replace")[:40],
+            # local time
+            to_Ticks(DateEnd.astimezone().replace(tzinfo=None) if DateEnd.tzinfo is not None else DateEnd),
+            to_Ticks(DateEnd),
+        )
+        self._Timestamps = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.filename)))
+        self._fd = os.open(pifcap_image.get_TempName(self.filename), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.write(self._fd, Header)
+        self._Geometry = (array.shape, array.dtype, Img.format)
+
+    def append(self, Img, on_Serialized=None):
+        """append frame
+
+        Args:
+            Img: pifcap_image.Image
+            on_Serialized: optional function called when the frame is ready for writing
+
+        Returns:
+            number of bytes written
+        """
+        BayerPattern, bit_depth = pifcap_image.parse_Format(Img.format)
+        array = Img.array.view(np.uint16 if bit_depth > 8 else np.uint8)
+        # cropped frames are views with row stride: copy to write with one system call
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        if on_Serialized is not None:
+            on_Serialized()
+        with self._Lock:
+            if self._closed:
+                raise ValueError(f'SER file {self.filename} is already closed')
+            if self._fd is None:
+                self._open(Img, array, bit_depth)
+            elif self._Geometry != (array.shape, array.dtype, Img.format):
+                raise ValueError(f'frame geometry {array.shape} {Img.format} does not match {self.filename}')
+            nBytes = fitswriter.write_Buffers(self._fd, [array.data])
+            self._Timestamps.write(_Timestamp.pack(to_Ticks(Img.metadata["DateEnd"])))
+            self._nFrames += 1
+            return nBytes
+
+    def close(self):
+        """write frame count and timestamp trailer and close file
+        """
+        with self._Lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._fd is None:
+                # no frame recorded
+                return
+            try:
+                os.pwrite(self._fd, struct.pack("<i", self._nFrames), _FrameCountOffset)
+                # copy spooled timestamps in chunks
+                self._Timestamps.seek(0)
+                while True:
+                    Chunk = self._Timestamps.read(1024 * 1024)
+                    if not Chunk:
+                        break
+                    fitswriter.write_Buffers(self._fd, [Chunk])
+            finally:
+                self._Timestamps.close()
+                self._Timestamps = None
+                os.close(self._fd)
+                self._fd = None
+            os.replace(pifcap_image.get_TempName(self.filename), self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
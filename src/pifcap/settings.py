@@ -4,6 +4,7 @@ managing application settings, including a QtDialog to change them
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
+import types
 import pyqtgraph.parametertree
 
 from . import settings_ui
@@ -25,9 +26,34 @@ class SettingsDialog(QtWidgets.QDialog):
         self.Settings = settings
         self.Params = pyqtgraph.parametertree.Parameter.create(name='params', type='group', children=settings)
         self.ui.ParamTree.setParameters(self.Params, showTop=False)
+        # flat read-only copy of all values, rebuilt on every change of the parameter tree
+        self._Snapshot = None
+        self.update_Snapshot()
+        self.Params.sigTreeStateChanged.connect(self.update_Snapshot)
+
+    def update_Snapshot(self, *args):
+        """rebuild flat settings snapshot from parameter tree
+
+        The snapshot gets replaced as a whole, so readers in other threads always see a consistent
+        set of values.
+        """
+        # recursive function to traverse the tree
+        def _traverseTree(Snapshot, Params, path):
+            for p in Params:
+                if p.type() != "group":
+                    Snapshot[path + (p.name(),)] = p.value()
+                _traverseTree(Snapshot, p, path + (p.name(),))
+        #
+        Snapshot = dict()
+        _traverseTree(Snapshot, self.Params, tuple())
+        self._Snapshot = types.MappingProxyType(Snapshot)
+
+    def snapshot(self):
+        """return read-only mapping (names tuple) -> value of all settings"""
+        return self._Snapshot
 
     def get(self, *names):
-        return self.Params.child(*names).value()
+        return self._Snapshot[names]
 
     def store_QSettings(self):
         """stores all settings in QSettings"""
@@ -59,7 +85,9 @@ class SettingsDialog(QtWidgets.QDialog):
                     p.setValue(QSettings.value(name2key(p.name()), p.value()))
         #
         QSettings = QtCore.QSettings()
-        _traverseTree(QSettings, self.Params)
+        # rebuild snapshot only once after loading all values
+        with self.Params.treeChangeBlocker():
+            _traverseTree(QSettings, self.Params)
 
 
 
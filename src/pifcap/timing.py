@@ -0,0 +1,181 @@
+"""
+per-frame timing of the capture pipeline
+
+Each stage of a frame (exposure end, buffer receipt, ...) gets marked with a time stamp. Delays of all
+stages relative to the exposure end are kept in rolling windows for histograms and percentiles and can
+be exported to a CSV file per recording session.
+
+Frames queued for scoring or writing are held: they are not evaluated before they are written, and the
+CSV file of a stopped session is closed only after all its held frames are released.
+"""
+
+import threading
+import collections
+import time
+import numpy as np
+
+settings = {'name': 'pipeline timing', 'type': 'group', 'children': [
+    {
+        'name': 'window length', 'type': 'int', 'value': 1000, 'limits': [10, 100000], 'suffix': ' frames',
+        'tip': 'number of frames used for timing statistics',
+    },
+    {
+        'name': 'export CSV', 'type': 'bool', 'value': False,
+        'tip': 'write timing of all recorded frames to a CSV file per recording session',
+    },
+]}
+
+# pipeline stages in processing order
+Stages = ("exposure end", "buffer receipt", "metadata", "serialization", "write", "preview")
+
+# frames (not counting held frames) waiting for more marks before they get evaluated
+PendingFrames = 128
+
+
+class PipelineTiming:
+    """collects time stamps of pipeline stages per frame
+    """
+
+    def __init__(self, WindowLength=1000):
+        self._Lock = threading.Lock()
+        self._Pending = collections.OrderedDict()
+        self._Delays = {Stage: collections.deque(maxlen=WindowLength) for Stage in Stages[1:]}
+        self._CSV = None
+        # frames queued for writing: number of holds and CSV file of their session
+        self._Held = collections.Counter()
+        self._Destinations = dict()
+        # CSV files of stopped sessions waiting for held frames
+        self._Closing = list()
+
+    def mark(self, FrameNumber, Stage, t=None):
+        """mark time of stage for a frame
+
+        Args:
+            FrameNumber: frame number
+            Stage: one of Stages
+            t: time stamp from time.perf_counter(), current time when None
+        """
+        if t is None:
+            t = time.perf_counter()
+        with self._Lock:
+            if FrameNumber not in self._Pending:
+                self._Pending[FrameNumber] = dict()
+                # evaluate oldest frames which are not held
+                while len(self._Pending) > PendingFrames + len(self._Held):
+                    Oldest = next((f for f in self._Pending if f not in self._Held), None)
+                    if Oldest is None:
+                        break
+                    self._evaluate(Oldest, self._Pending.pop(Oldest))
+            self._Pending[FrameNumber][Stage] = t
+
+    def hold(self, FrameNumber):
+        """keep frame pending until `release` is called as often as `hold`
+
+        A frame held first during a session goes into the CSV file of this session.
+        """
+        with self._Lock:
+            self._Held[FrameNumber] += 1
+            self._Pending.setdefault(FrameNumber, dict())
+            if (self._CSV is not None) and (FrameNumber not in self._Destinations):
+                self._Destinations[FrameNumber] = self._CSV
+
+    def release(self, FrameNumber):
+        """release frame held by `hold` (frame written, dropped or not selected)
+        """
+        with self._Lock:
+            if self._Held[FrameNumber] <= 1:
+                self._Held.pop(FrameNumber, None)
+            else:
+                self._Held[FrameNumber] -= 1
+            self._close_Sessions()
+
+    def _evaluate(self, FrameNumber, Marks):
+        """add delays of a frame to statistics; must be called with lock held
+        """
+        CSV = self._Destinations.pop(FrameNumber, self._CSV)
+        t0 = Marks.get("exposure end", None)
+        if t0 is None:
+            return
+        Delays = {Stage: Marks[Stage] - t0 for Stage in Stages[1:] if Stage in Marks}
+        for Stage, Delay in Delays.items():
+            self._Delays[Stage].append(Delay)
+        # only recorded frames go into the CSV file
+        if (CSV is not None) and ("write" in Delays):
+            CSV.write(
+                f'{FrameNumber},' +
+                ",".join(f'{Delays[Stage] * 1e3:.3f}' if Stage in Delays else "" for Stage in Stages[1:]) +
+                "\n"
+            )
+
+    def flush(self):
+        """evaluate all pending frames which are not held
+        """
+        with self._Lock:
+            self._flush()
+
+    def _flush(self):
+        """evaluate all pending frames which are not held; must be called with lock held
+        """
+        for FrameNumber in [f for f in self._Pending if f not in self._Held]:
+            self._evaluate(FrameNumber, self._Pending.pop(FrameNumber))
+
+    def _close_Sessions(self):
+        """close CSV files of stopped sessions without held frames; must be called with lock held
+        """
+        for CSV in list(self._Closing):
+            if any(self._Destinations.get(f, None) is CSV for f in self._Held):
+                continue
+            self._flush()
+            CSV.close()
+            self._Closing.remove(CSV)
+
+    def start_Session(self, filename):
+        """start writing frame timing to CSV file
+
+        Args:
+            filename: name of CSV file
+        """
+        self.stop_Session()
+        with self._Lock:
+            self._CSV = open(filename, "w")
+            self._CSV.write("frame," + ",".join(f'{Stage} [ms]' for Stage in Stages[1:]) + "\n")
+
+    def stop_Session(self):
+        """evaluate pending frames and close CSV file
+
+        The CSV file stays open until all frames held during the session are released.
+        """
+        with self._Lock:
+            if self._CSV is not None:
+                self._Closing.append(self._CSV)
+                self._CSV = None
+            self._flush()
+            self._close_Sessions()
+
+    def get_Percentiles(self, percentiles=(50, 90, 99, 100)):
+        """return dict stage -> list of delay percentiles in seconds (None when no data)
+        """
+        with self._Lock:
+            Delays = {Stage: np.array(d) for Stage, d in self._Delays.items()}
+        return {
+            Stage: (list(np.percentile(d, percentiles)) if d.size > 0 else None)
+            for Stage, d in Delays.items()
+        }
+
+    def get_Histogram(self, Stage, bins=20):
+        """return histogram (counts, bin edges in seconds) of delays of a stage
+        """
+        with self._Lock:
+            d = np.array(self._Delays[Stage])
+        return np.histogram(d, bins=bins)
+
+    def summary(self):
+        """return text with delay percentiles of all stages
+        """
+        Lines = list()
+        for Stage, p in self.get_Percentiles().items():
+            if p is not None:
+                Lines.append(
+                    f'{Stage}: ' + ", ".join(f'{name} {v * 1e3:.1f}ms' for name, v in zip(["p50", "p90", "p99", "max"], p))
+                )
+        return "; ".join(Lines)
@@ -0,0 +1,349 @@
+"""
+asynchronous frame writer
+
+Frames are handed over by the exposure loop and saved by writer threads. This keeps slow storage
+(SD-card, USB stick) out of the capture path.
+
+A frame gets written either to its own file or appended to a sequence file
+(`pifcap_sequence.SequenceWriter`) or SER video (`serwriter.SERWriter`). Frames of the same sequence
+file or SER video are written by one thread at a time in queue order, so parallel writer threads only
+speed up recording of single frame files.
+"""
+
+import threading
+import collections
+import time
+import shutil
+
+settings = {'name': 'frame writer', 'type': 'group', 'children': [
+    {
+        'name': 'queue length', 'type': 'int', 'value': 16, 'limits': [1, 1000], 'suffix': ' frames',
+        'tip': 'maximum number of frames waiting to be written',
+    },
+    {
+        'name': 'writer threads', 'type': 'int', 'value': 1, 'limits': [1, 8],
+        'tip': 'number of threads writing frames in parallel; frames of a sequence file or SER video are written one after the other, '
+               'so more than one thread helps only with single frame files',
+    },
+    {
+        'name': 'file container', 'type': 'list', 'values': ['sequence file', 'single frames', 'SER video'],
+        'value': 'sequence file',
+        'tip': 'store all frames of a recording run in one sequence file, each frame in its own file or all frames in one SER video (no metadata besides timestamps)',
+    },
+    {
+        'name': 'pixel encoding', 'type': 'list', 'values': ['raw', 'packed'],
+        'value': 'raw',
+        'tip': 'raw: 10 and 12 bit pixels in 16 bit containers; packed: without unused bits, 25 % (12 bit) or 37.5 % (10 bit) smaller files. '
+               'Packing needs CPU time on the writer thread and pays off only on storage slower than the packing; '
+               '"python -m pifcap.pifcap_image <folder>" measures pack time and break-even storage speed. Not used for SER videos',
+    },
+    {
+        'name': 'queue full policy', 'type': 'list', 'values': ['block', 'drop oldest', 'drop newest'],
+        'value': 'block',
+        'tip': 'what to do when the queue is full: block the exposure loop, drop the oldest or the newest frame',
+    },
+    {
+        'name': 'disk space refresh period', 'type': 'float', 'value': 5.0, 'limits': [0.5, 600], 'suffix': ' s',
+        'tip': 'time between free disk space measurements',
+    },
+    {
+        'name': 'disk space refresh amount', 'type': 'int', 'value': 256, 'limits': [1, 100000], 'suffix': ' MiB',
+        'tip': 'measure free disk space again after writing this amount of data',
+    },
+]}
+
+
+class DiskSpaceMonitor:
+    """measures free disk space in a background thread
+
+    Free space gets measured periodically and after a given amount of data was written. In between the
+    written data are subtracted from the last measurement.
+    """
+
+    def __init__(self, Folder, Period=5.0, RefreshBytes=256 * 1024 * 1024):
+        self.Period = Period
+        self.RefreshBytes = RefreshBytes
+        self._Folder = Folder
+        self._Free = 0
+        self._WrittenSinceRefresh = 0
+        self._Cond = threading.Condition()
+        self._Refresh = False
+        self._Stop = False
+        self._Thread = None
+
+    def start(self):
+        """measure free space and start background thread
+        """
+        self._measure()
+        self._Stop = False
+        self._Thread = threading.Thread(target=self._run, name='DiskSpaceMonitor', daemon=True)
+        self._Thread.start()
+
+    def stop(self):
+        """stop background thread
+        """
+        with self._Cond:
+            self._Stop = True
+            self._Cond.notify_all()
+        if self._Thread is not None:
+            self._Thread.join()
+            self._Thread = None
+
+    def set_Folder(self, Folder):
+        """change observed folder
+        """
+        with self._Cond:
+            if Folder != self._Folder:
+                self._Folder = Folder
+                self._Refresh = True
+                self._Cond.notify_all()
+
+    def add_Written(self, nBytes):
+        """account data written to the observed folder
+        """
+        with self._Cond:
+            self._WrittenSinceRefresh += nBytes
+            if self._WrittenSinceRefresh >= self.RefreshBytes:
+                self._Refresh = True
+                self._Cond.notify_all()
+
+    def get_Free(self):
+        """return estimated free disk space in bytes
+        """
+        with self._Cond:
+            return max(0, self._Free - self._WrittenSinceRefresh)
+
+    def _measure(self):
+        with self._Cond:
+            Folder = self._Folder
+            self._Refresh = False
+        try:
+            disc_total, disc_used, disc_free = shutil.disk_usage(Folder)
+        except OSError:
+            # folder does not exist (yet)
+            disc_free = 0
+        with self._Cond:
+            if Folder == self._Folder:
+                self._Free = disc_free
+                self._WrittenSinceRefresh = 0
+
+    def _run(self):
+        while True:
+            with self._Cond:
+                if not (self._Refresh or self._Stop):
+                    self._Cond.wait(timeout=self.Period)
+                if self._Stop:
+                    return
+            self._measure()
+
+
+class FrameWriter:
+    """bounded frame queue with writer threads
+    """
+
+    Policies = ('block', 'drop oldest', 'drop newest')
+
+    def __init__(self, QueueLength=16, nThreads=1, Policy='block', DiskMonitor=None, Timing=None):
+        if Policy not in self.Policies:
+            raise ValueError(f'unknown queue full policy {Policy}')
+        self.QueueLength = max(1, QueueLength)
+        self.nThreads = max(1, nThreads)
+        self.Policy = Policy
+        self.DiskMonitor = DiskMonitor
+        self.Timing = Timing
+        self._Queue = collections.deque()
+        self._Cond = threading.Condition()
+        self._Threads = list()
+        self._Stop = False
+        # sequence files to close when all their frames are written
+        self._Closing = list()
+        self._Busy = collections.Counter()
+        self.reset_Stats()
+
+    def reset_Stats(self):
+        """reset statistics counters
+        """
+        with self._Cond:
+            self._PeakDepth = len(self._Queue)
+            self._Written = 0
+            self._Blocked = 0
+            self._BlockedTime = 0.0
+            self._Dropped = 0
+            self._Errors = 0
+            self._LastError = None
+
+    def start(self):
+        """start writer threads
+        """
+        with self._Cond:
+            self._Stop = False
+        for i in range(self.nThreads):
+            t = threading.Thread(target=self._run, name=f'FrameWriter-{i}', daemon=True)
+            t.start()
+            self._Threads.append(t)
+
+    def stop(self, flush=True):
+        """stop writer threads
+
+        Args:
+            flush: write all queued frames before stopping, otherwise discard them
+        """
+        with self._Cond:
+            if not flush:
+                self._Dropped += len(self._Queue)
+                for Img, Target in self._Queue:
+                    self._release_Timing(Img)
+                self._Queue.clear()
+            self._Stop = True
+            self._Cond.notify_all()
+        for t in self._Threads:
+            t.join()
+        self._Threads = list()
+        with self._Cond:
+            self._close_Targets()
+
+    def is_Running(self):
+        return len(self._Threads) > 0
+
+    def put(self, Img, Target):
+        """queue frame for writing
+
+        Args:
+            Img: pifcap_image.Image to save
+            Target: name of file to write or pifcap_sequence.SequenceWriter (serwriter.SERWriter) to append to
+
+        Returns:
+            True when frame was queued, False when it was dropped
+        """
+        with self._Cond:
+            if len(self._Queue) >= self.QueueLength:
+                if self.Policy == 'drop newest':
+                    self._Dropped += 1
+                    return False
+                elif self.Policy == 'drop oldest':
+                    self._release_Timing(self._Queue.popleft()[0])
+                    self._Dropped += 1
+                else:
+                    # 'block'
+                    self._Blocked += 1
+                    t0 = time.monotonic()
+                    while (len(self._Queue) >= self.QueueLength) and not self._Stop:
+                        self._Cond.wait()
+                    self._BlockedTime += time.monotonic() - t0
+            # keep timing of frame until it is written
+            FrameNumber = Img.metadata.get("FrameNumber", None)
+            if (self.Timing is not None) and (FrameNumber is not None):
+                self.Timing.hold(FrameNumber)
+            self._Queue.append((Img, Target))
+            self._PeakDepth = max(self._PeakDepth, len(self._Queue))
+            self._Cond.notify_all()
+        return True
+
+    def close(self, Target):
+        """close sequence file after all queued frames for it are written
+
+        Args:
+            Target: pifcap_sequence.SequenceWriter
+        """
+        with self._Cond:
+            self._Closing.append(Target)
+            self._close_Targets()
+
+    def _close_Targets(self):
+        """close sequence files without pending frames; must be called with lock held
+        """
+        for Target in list(self._Closing):
+            is_Pending = (self._Busy[Target] > 0) or any(t is Target for _, t in self._Queue)
+            if is_Pending and (len(self._Threads) > 0):
+                continue
+            self._Closing.remove(Target)
+            try:
+                Target.close()
+            except Exception as e:
+                self._Errors += 1
+                self._LastError = f'{Target.filename}: {e}'
+
+    def _release_Timing(self, Img):
+        """release timing of a frame held by `put`
+        """
+        FrameNumber = Img.metadata.get("FrameNumber", None)
+        if (self.Timing is not None) and (FrameNumber is not None):
+            self.Timing.release(FrameNumber)
+
+    def get_Stats(self):
+        """return dict with queue statistics
+        """
+        with self._Cond:
+            return {
+                "depth": len(self._Queue),
+                "peak_depth": self._PeakDepth,
+                "written": self._Written,
+                "blocked": self._Blocked,
+                "blocked_time": self._BlockedTime,
+                "dropped": self._Dropped,
+                "errors": self._Errors,
+                "last_error": self._LastError,
+            }
+
+    def _next_Item(self):
+        """remove and return oldest queued (Img, Target) which can be written now; must be called with lock held
+
+        Frames appended to a sequence file or SER video wait while another thread writes to the same
+        file, this keeps them in recording order.
+
+        Returns:
+            None when there is no such frame
+        """
+        for i, (Img, Target) in enumerate(self._Queue):
+            if isinstance(Target, str) or (self._Busy[Target] == 0):
+                del self._Queue[i]
+                return Img, Target
+        return None
+
+    def _run(self):
+        """writer thread
+        """
+        while True:
+            with self._Cond:
+                while True:
+                    Item = self._next_Item()
+                    if (Item is not None) or (self._Stop and (len(self._Queue) == 0)):
+                        break
+                    self._Cond.wait()
+                if Item is None:
+                    # stop requested and nothing left to write
+                    return
+                Img, Target = Item
+                self._Busy[Target] += 1
+                # wake up blocked producer
+                self._Cond.notify_all()
+            FrameNumber = Img.metadata.get("FrameNumber", None)
+            if (self.Timing is not None) and (FrameNumber is not None):
+                on_Serialized = lambda: self.Timing.mark(FrameNumber, "serialization")
+            else:
+                on_Serialized = None
+            try:
+                if isinstance(Target, str):
+                    nBytes = Img.save(filename=Target, on_Serialized=on_Serialized)
+                else:
+                    nBytes = Target.append(Img, on_Serialized=on_Serialized)
+                if on_Serialized is not None:
+                    self.Timing.mark(FrameNumber, "write")
+                if self.DiskMonitor is not None:
+                    self.DiskMonitor.add_Written(nBytes)
+            except Exception as e:
+                with self._Cond:
+                    self._Errors += 1
+                    self._LastError = f'{Target if isinstance(Target, str) else Target.filename}: {e}'
+            else:
+                with self._Cond:
+                    self._Written += 1
+            finally:
+                self._release_Timing(Img)
+                with self._Cond:
+                    self._Busy[Target] -= 1
+                    if self._Busy[Target] <= 0:
+                        del self._Busy[Target]
+                    self._close_Targets()
+                    # frames for this target can be written by other threads now
+                    self._Cond.notify_all()
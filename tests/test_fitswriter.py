@@ -0,0 +1,43 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from pifcap import fitswriter
+from pifcap import pifcap_image
+
+
+def make_Image(CameraModel):
+    metadata = {
+        "CameraModel": CameraModel,
+        "ExposureTime": 1000,
+        "DateEnd": datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc),
+        "UnitCellSize": (1550, 1550),
+        "Binning": (1, 1),
+        "FrameType": "Light",
+        "AnalogueGain": 1.0,
+    }
+    array = np.arange(8 * 6, dtype=np.uint16).reshape((8, 6)).view(np.uint8)
+    return pifcap_image.Image(array=array, metadata=metadata, format="SRGGB12", comment="")
+
+
+@pytest.mark.parametrize("value", ["x" * 90, "'" * 50, "a" * 67 + "'", "short"])
+def test_format_Card_long_string(value):
+    fits = pytest.importorskip("astropy.io.fits")
+    card = fitswriter.format_Card("OBJECT", value, "object name")
+    assert len(card) == fitswriter.CARD_SIZE
+    c = fits.Card.fromstring(card)
+    c.verify("exception")
+    assert c.value == fitswriter.fit_String(value)
+    assert value.startswith(c.value)
+
+
+@pytest.mark.parametrize("CameraModel", ["x" * 90, "it's a very long camera model name with 'quotes' " * 2])
+def test_long_string_header(tmp_path, CameraModel):
+    fits = pytest.importorskip("astropy.io.fits")
+    img = make_Image(CameraModel)
+    filename = str(tmp_path / "frame.fits")
+    fitswriter.FITSWriter().write(img, filename)
+    fitswriter.verify_FITS(img, filename)
+    with fits.open(filename) as hdul:
+        hdul.verify("exception")
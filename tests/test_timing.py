@@ -0,0 +1,71 @@
+import csv
+import time
+
+from pifcap import timing
+from pifcap import writer
+
+
+class SlowTarget:
+    """sequence writer stand-in which needs some time per frame"""
+
+    filename = "slow"
+
+    def __init__(self, Delay=0.002):
+        self.Delay = Delay
+        self.Frames = list()
+
+    def append(self, Img, on_Serialized=None):
+        if on_Serialized is not None:
+            on_Serialized()
+        time.sleep(self.Delay)
+        self.Frames.append(Img.metadata["FrameNumber"])
+        return 1
+
+    def close(self):
+        pass
+
+
+class Frame:
+    def __init__(self, FrameNumber):
+        self.metadata = {"FrameNumber": FrameNumber}
+
+
+def read_CSVFrames(filename):
+    with open(filename, newline="") as fh:
+        return [int(row["frame"]) for row in csv.DictReader(fh)]
+
+
+def test_session_waits_for_queued_frames(tmp_path):
+    nFrames = 2 * timing.PendingFrames
+    Timing = timing.PipelineTiming()
+    Writer = writer.FrameWriter(QueueLength=nFrames, Timing=Timing)
+    Target = SlowTarget()
+    CSVName = tmp_path / "timing.csv"
+    Timing.start_Session(CSVName)
+    Writer.start()
+    for FrameNumber in range(nFrames):
+        Timing.mark(FrameNumber, "exposure end")
+        Writer.put(Frame(FrameNumber), Target)
+    # recording stops while the writer is still busy
+    Timing.stop_Session()
+    assert len(Target.Frames) < nFrames
+    Writer.close(Target)
+    Writer.stop(flush=True)
+    assert Target.Frames == list(range(nFrames))
+    assert read_CSVFrames(CSVName) == list(range(nFrames))
+
+
+def test_dropped_frames_release_session(tmp_path):
+    Timing = timing.PipelineTiming()
+    Writer = writer.FrameWriter(QueueLength=2, Policy='drop newest', Timing=Timing)
+    Target = SlowTarget()
+    CSVName = tmp_path / "timing.csv"
+    Timing.start_Session(CSVName)
+    for FrameNumber in range(5):
+        Timing.mark(FrameNumber, "exposure end")
+        Writer.put(Frame(FrameNumber), Target)
+    Timing.stop_Session()
+    Writer.start()
+    Writer.stop(flush=True)
+    assert Target.Frames == [0, 1]
+    assert read_CSVFrames(CSVName) == [0, 1]